@@ -11,27 +11,33 @@ This controller defines the safedata_server API endpoints, which are used to:
 Individual API endpoints are exposed using the web2py @request.restful decorator.
 """
 
+import hashlib
 import os
 import sys
 import traceback
 import inspect
 import json
+from collections import OrderedDict
 
 from gluon.serializers import json as web2py_json
 
 from safedata_server_api import (
-    dataset_taxon_search,
-    dataset_author_search,
-    dataset_date_search,
-    dataset_text_search,
-    dataset_field_search,
-    dataset_locations_search,
-    dataset_spatial_search,
-    dataset_spatial_bbox_search,
+    GAZETTEER_DETAIL,
+    SEARCH_CACHE,
+    SEARCH_FACETS,
+    SEARCH_FUNC,
+    SEARCH_REGISTRY,
+    dataset_batch_spatial_search,
     dataset_query_to_json,
+    get_coverage,
+    get_gazetteer_file,
     get_index,
+    get_record,
+    get_records,
+    get_taxa,
     server_post_metadata,
     server_update_gazetteer,
+    stream_json,
 )
 
 
@@ -44,23 +50,14 @@ API_ENDPOINTS = [
     "metadata_index",
     "metadata_index_hashes",
     "record",
+    "records",
     "files",
     "taxa",
+    "coverage",
     "search",
+    "batch_search",
 ]
 
-# A dictionary of search endpoint names and the underlying functions.
-SEARCH_FUNC = {
-    "taxa": dataset_taxon_search,
-    "authors": dataset_author_search,
-    "dates": dataset_date_search,
-    "text": dataset_text_search,
-    "fields": dataset_field_search,
-    "locations": dataset_locations_search,
-    "spatial": dataset_spatial_search,
-    "bbox": dataset_spatial_bbox_search,
-}
-
 
 # ------------------------------------------------------------------
 # Website dataset API index page
@@ -97,26 +94,30 @@ def index():
 # ------------------------------------------------------------------
 
 
-def _parse_vars(vars):
-    if "most_recent" in vars:
-        most_recent = vars.pop("most_recent")
-
-        if most_recent == "":
-            most_recent = True
+def _parse_flag(vars, flag):
+    if flag in vars:
+        # Flags are given without a value in query strings, or as booleans in JSON
+        value = vars.pop(flag)
+        if value == "" or isinstance(value, bool):
+            return value is not False
         else:
-            raise HTTP(400, "Do not provide a value for the most_recent query flag.")
-    else:
-        most_recent = False
+            raise HTTP(400, f"Do not provide a value for the {flag} query flag.")
+
+    return False
+
+
+def _parse_vars(vars):
+    most_recent = _parse_flag(vars, "most_recent")
 
     if "ids" in vars:
         ids = vars.pop("ids")
 
-        if isinstance(ids, str):
+        if not isinstance(ids, list):
             ids = [ids]
 
         try:
             ids = [int(vl) for vl in ids]
-        except ValueError:
+        except (TypeError, ValueError):
             raise HTTP(400, "Invalid ids value")
 
     else:
@@ -125,19 +126,79 @@ def _parse_vars(vars):
     return most_recent, ids
 
 
+def _parse_page_vars(vars):
+    if "limit" in vars:
+        try:
+            limit = int(vars.pop("limit"))
+        except (TypeError, ValueError):
+            raise HTTP(400, "Invalid limit value")
+
+        if limit < 1:
+            raise HTTP(400, "The limit value must be a positive integer")
+    else:
+        limit = None
+
+    cursor = vars.pop("cursor", None)
+
+    if cursor is not None and not isinstance(cursor, str):
+        raise HTTP(400, "Invalid cursor value")
+
+    return limit, cursor
+
+
+def _parse_facets(vars):
+    if "facets" not in vars:
+        return None
+
+    # Facets can be provided as a comma separated string, repeated or as a JSON list
+    facets = vars.pop("facets")
+    if not isinstance(facets, list):
+        facets = [facets]
+
+    facets = [fct for fcts in facets for fct in str(fcts).split(",") if fct]
+    unknown_facets = [fct for fct in facets if fct not in SEARCH_FACETS]
+
+    if unknown_facets:
+        raise HTTP(400, f"Unknown facets: {','.join(unknown_facets)}")
+
+    return list(OrderedDict.fromkeys(facets))
+
+
+def _stream_response(chunks):
+    # Streamed responses bypass the view, so set the content type directly. The
+    # restful decorator JSON encodes values returned for JSON requests, so the chunks
+    # are instead sent by raising them as the body of the HTTP response.
+    if request.env.content_type == "application/json":
+        raise HTTP(200, chunks, **{"Content-Type": "application/json"})
+
+    response.headers["Content-Type"] = "application/json"
+    return chunks
+
+
 @request.restful()
 def gazetteer():
     """Returns the content of the gazetteer GeoJSON file.
 
+    The optional detail variable can be used to get a smaller version of the gazetteer,
+    with simplified location geometries and rounded coordinates, for uses such as
+    overview maps. The detail can be "full", the default, or "high", "medium" or "low",
+    which simplify the geometries to within around 1, 10 and 100 metres. The hashes of
+    each version are included in the metadata index hashes.
+
     Example use:
         /api/gazetteer.json
+        /api/gazetteer.json?detail=low
     """
 
     response.view = "generic.json"
 
     def GET(*args, **vars):
+        detail = vars.get("detail", "full")
+        if detail != "full" and detail not in GAZETTEER_DETAIL:
+            raise HTTP(400, f"Unknown gazetteer detail: {detail}")
+
         try:
-            fpath = os.path.join(request.folder, "static/files/gis/gazetteer.geojson")
+            fpath = get_gazetteer_file(detail)
             with open(fpath, "rb") as fdata:
                 return fdata.read()
         except FileNotFoundError as err:
@@ -190,8 +251,11 @@ def metadata_index_hashes():
 def metadata_index():
     """Get the complete dataset metadata index
 
+    This endpoint accepts the shared <code>stream</code> query flag.
+
     Example use:
         /api/metadata_index.json
+        /api/metadata_index.json?stream
     """
 
     # The output from this endpoint is used as the core index for the safedata
@@ -204,7 +268,12 @@ def metadata_index():
     response.view = "generic.json"
 
     def GET(*args, **vars):
+        stream = _parse_flag(vars, "stream")
         val = cache.ram("index", get_index, time_expire=None)["index"]
+
+        if stream:
+            return _stream_response(stream_json(val))
+
         return web2py_json(val)
 
     return locals()
@@ -235,6 +304,11 @@ def post_metadata():
         except Exception as err:
             raise HTTP(400, str(err))
 
+        # Commit the publication and then clear cached search results, so that results
+        # read before the commit are not kept
+        db.commit()
+        SEARCH_CACHE.clear()
+
         # Update the response status code for POST action and return inserted entry
         response.status = 201
         return val
@@ -295,28 +369,14 @@ def record():
             except ValueError:
                 raise HTTP(400, "Non-integer record number")
             else:
-                record = (
-                    db(db.published_datasets.zenodo_record_id == record_id)
-                    .select()
-                    .first()
-                )
+                # The record metadata is built in the database and returned as JSON
+                # text, without decoding and encoding the metadata again.
+                val = get_record(record_id)
 
-                if record is None:
+                if val is None:
                     raise HTTP(404, "Unknown record number.")
                 else:
-                    # Build the record metadata, including taxa and locations
-                    val = record.dataset_metadata
-                    val["publication_date"] = record.publication_date
-                    val["zenodo_concept_id"] = record.zenodo_concept_id
-                    val["zenodo_record_id"] = record.zenodo_record_id
-                    # TODO: Decide here!
-                    # val["taxa"] = record.dataset_taxa.select()
-                    # val["locations"] = record.dataset_locations.select(
-                    #     db.dataset_locations.name,
-                    #     db.dataset_locations.new_location,
-                    #     db.dataset_locations.wkt_wgs84,
-                    # )
-
+                    response.headers["Content-Type"] = "application/json"
                     return val
 
         raise HTTP(400, "Bad request: records endpoint requires one integer argument")
@@ -324,6 +384,40 @@ def record():
     return locals()
 
 
+@request.restful()
+def records():
+    """Get JSON metadata for many dataset records.
+
+    This endpoint streams a JSON array of the metadata for many dataset records, in the
+    same format as the record endpoint, sorted by Zenodo record ID. This can be used to
+    get the metadata for many records in a single request. The records are selected
+    using the shared <code>ids</code> and <code>most_recent</code> variables, and
+    the metadata for all records is returned if neither is provided. Long lists of ids
+    can be sent as a JSON array in the body of a POST request.
+
+    Example usage:
+        /api/records.json?ids=1198302&ids=1995439
+        /api/records.json?most_recent
+        POST /api/records.json
+        {"ids": [1198302, 1995439]}
+    """
+    response.view = "generic.json"
+
+    def GET(*args, **vars):
+        most_recent, ids = _parse_vars(vars)
+
+        if vars:
+            raise HTTP(400, f"Unknown variables for records: {','.join(sorted(vars))}")
+
+        return _stream_response(get_records(ids, most_recent))
+
+    def POST(*args, **vars):
+        # The variables from a JSON request body are included in vars by web2py
+        return GET(*args, **vars)
+
+    return locals()
+
+
 @request.restful()
 def files():
     """Get the files associated with datasets.
@@ -334,47 +428,56 @@ def files():
     download link is only functional when a dataset is open access or if the listed
     embargo date has passed.
 
-    This endpoint does accept the shared <code>ids</code> or <code>most_recent</code>
-    query parameters.
+    This endpoint does accept the shared <code>ids</code>, <code>most_recent</code>,
+    <code>limit</code>, <code>cursor</code> and <code>stream</code> query parameters.
 
     Example usage:
         /api/files.json
         /api/files.json?most_recent
+        /api/files.json?limit=100
+        /api/files.json?stream
     """
     response.view = "generic.json"
 
     def GET(*args, **vars):
         most_recent, ids = _parse_vars(vars)
+        limit, cursor = _parse_page_vars(vars)
+        stream = _parse_flag(vars, "stream")
 
         # /api/files endpoint provides a json file containing the files associated
-        # with dataset records, allowing filtering by ID and most_recent query parameters
-
-        # version of the data contained in the dataset description
+        # with dataset records, allowing filtering by ID and most_recent query
+        # parameters. The files are sorted by record id and then file name.
         qry = db.published_datasets.id == db.dataset_files.dataset_id
-        val = dataset_query_to_json(
-            qry,
-            most_recent,
-            ids,
-            fields=[
-                ("published_datasets", "publication_date"),
-                ("published_datasets", "zenodo_concept_id"),
-                ("published_datasets", "zenodo_record_id"),
-                ("published_datasets", "dataset_access"),
-                ("published_datasets", "dataset_embargo"),
-                ("published_datasets", "dataset_title"),
-                ("published_datasets", "most_recent"),
-                ("dataset_files", "checksum"),
-                ("dataset_files", "filename"),
-                ("dataset_files", "filesize"),
-            ],
-        )
 
-        # repackage the db output into a single dictionary per file
-        entries = val["entries"].as_list()
-        [r["published_datasets"].update(r.pop("dataset_files")) for r in entries]
-        val["entries"] = [r["published_datasets"] for r in entries]
+        try:
+            val = dataset_query_to_json(
+                qry,
+                most_recent,
+                ids,
+                fields=[
+                    ("published_datasets", "publication_date"),
+                    ("published_datasets", "zenodo_concept_id"),
+                    ("published_datasets", "zenodo_record_id"),
+                    ("published_datasets", "dataset_access"),
+                    ("published_datasets", "dataset_embargo"),
+                    ("published_datasets", "dataset_title"),
+                    ("published_datasets", "most_recent"),
+                    ("dataset_files", "checksum"),
+                    ("dataset_files", "filename"),
+                    ("dataset_files", "filesize"),
+                ],
+                keys=[
+                    ("published_datasets", "zenodo_record_id"),
+                    ("dataset_files", "filename"),
+                ],
+                limit=limit,
+                cursor=cursor,
+                stream=stream,
+            )
+        except ValueError as err:
+            raise HTTP(400, str(err))
 
-        return val
+        return _stream_response(val) if stream else val
 
     return locals()
 
@@ -384,37 +487,118 @@ def taxa():
     """Get JSON data on the taxon names currently used in datasets.
 
     The response is a list of taxon details, including a count of the number of datasets
-    recording each taxon.
+    recording each taxon. The taxa can be filtered using one or more <code>auth</code>
+    (GBIF or NCBI) and <code>rank</code> values and using <code>name</code> to give the
+    case insensitive start of the taxon names. This endpoint accepts the shared
+    <code>limit</code>, <code>cursor</code> and <code>stream</code> query parameters:
+    if limit or cursor are used, the response instead includes the total count of
+    taxa, a JSON array of taxon details and the cursor for the next page of taxa.
+
+    Responses that are not streamed include an ETag header, which changes when new
+    datasets are published, so clients can use If-None-Match to check for changes.
 
     Example use:
         /api/taxa.json
+        /api/taxa.json?limit=500
+        /api/taxa.json?stream
+        /api/taxa.json?auth=GBIF&rank=family
+        /api/taxa.json?name=formic
     """
     response.view = "generic.json"
 
     def GET(*args, **vars):
-        taxon_fields = [
-            db.dataset_taxa.taxon_auth,
-            db.dataset_taxa.taxon_id,
-            db.dataset_taxa.taxon_rank,
-            db.dataset_taxa.taxon_name,
-            db.dataset_taxa.taxon_status,
-            db.dataset_taxa.parent_id,
-        ]
-
-        taxon_count = [db.dataset_taxa.taxon_name.count().with_alias("n_datasets")]
-
-        val = (
-            db(db.dataset_taxa)
-            .select(*taxon_fields + taxon_count, groupby=taxon_fields)
-            .as_list()
-        )
+        limit, cursor = _parse_page_vars(vars)
+        stream = _parse_flag(vars, "stream")
 
-        # repackage the Rows to provide a flat json per taxon format.
-        for txn in val:
-            txn.update(txn.pop("dataset_taxa"))
-            del txn["_extra"]
+        filters = {}
+        for key in ("auth", "rank"):
+            if key in vars:
+                values = vars.pop(key)
+                filters[key] = values if isinstance(values, list) else [values]
 
-        return web2py_json(val)
+        if "name" in vars:
+            filters["name"] = vars.pop("name")
+
+            if isinstance(filters["name"], list):
+                raise HTTP(400, "Provide a single name value")
+
+        if stream:
+            try:
+                return _stream_response(get_taxa(limit, cursor, stream, **filters))
+            except ValueError as err:
+                raise HTTP(400, str(err))
+
+        # Cache the serialised taxa with an ETag, until new datasets are published
+        def _taxa():
+            val = web2py_json(get_taxa(limit, cursor, **filters))
+            return hashlib.md5(val.encode("utf-8")).hexdigest(), val
+
+        try:
+            key = SEARCH_CACHE.key("taxa", filters, limit, cursor)
+            etag, val = SEARCH_CACHE.get(key, _taxa)
+        except ValueError as err:
+            raise HTTP(400, str(err))
+
+        response.headers["ETag"] = etag = f'"{etag}"'
+        response.headers["Content-Type"] = "application/json"
+
+        if_none_match = request.env.http_if_none_match or ""
+        if etag in [tag.strip() for tag in if_none_match.split(",")]:
+            raise HTTP(304, **response.headers)
+
+        return val
+
+    return locals()
+
+
+@request.restful()
+def coverage():
+    """Get a GeoJSON grid of the coverage of dataset sampling locations.
+
+    The response is a GeoJSON FeatureCollection of the grid cells that contain dataset
+    sampling locations, with the number of datasets in each cell, for drawing coverage
+    maps. The grid can be "hex" or "square" and the cell size is the width of the
+    cells in metres, which can be 1000, 5000 or 25000. If a year is provided, only
+    datasets with a temporal extent including that year are counted. This endpoint
+    accepts the shared <code>most_recent</code> query flag.
+
+    Example use:
+        /api/coverage.json
+        /api/coverage.json?grid=square&cell_size=25000
+        /api/coverage.json?year=2015&most_recent
+    """
+
+    response.view = "generic.json"
+
+    def GET(*args, **vars):
+        most_recent = _parse_flag(vars, "most_recent")
+        grid = vars.pop("grid", "hex")
+        cell_size = vars.pop("cell_size", 5000)
+        year = vars.pop("year", None)
+
+        if vars:
+            raise HTTP(400, f"Unknown variables for coverage: {','.join(sorted(vars))}")
+
+        if any(isinstance(val, list) for val in (grid, cell_size, year)):
+            raise HTTP(400, "Provide single grid, cell_size and year values")
+
+        try:
+            cell_size = int(cell_size)
+            year = None if year is None else int(year)
+        except (TypeError, ValueError):
+            raise HTTP(400, "Invalid cell_size or year value")
+
+        def _coverage():
+            return get_coverage(grid, cell_size, year, most_recent)
+
+        try:
+            key = SEARCH_CACHE.key("coverage", {}, grid, cell_size, year, most_recent)
+            val = SEARCH_CACHE.get(key, _coverage)
+        except ValueError as err:
+            raise HTTP(400, str(err))
+
+        response.headers["Content-Type"] = "application/json"
+        return val
 
     return locals()
 
@@ -426,34 +610,66 @@ def search():
     This endpoint provides a number of search options used to identify datasets that
     meet different search criteria. See the search function documentation below for the
     different search arguments and query variables.
+
+    Searches can also be sent as a POST request with a JSON body, giving the query
+    variables and shared variables as an object. This avoids limits on the length of
+    query strings for searches using long lists of values or ids. Lists of values are
+    given as JSON arrays and flags such as most_recent as true or false.
+
+    Example usage:
+        POST /api/search/taxa.json
+        {"name": ["Formicidae", "Isoptera"], "ids": [1198302, 1995439]}
     """
     response.view = "generic.json"
 
     def GET(*args, **vars):
-        if len(args) == 1 and args[0] in SEARCH_FUNC:
-            # validate the remaining query search parameters to the search function
-            # arguments
-            func = SEARCH_FUNC[args[0]]
-            fn_args = inspect.getargspec(func).args
-            unknown_args = set(vars) - set(fn_args)
-
-            if unknown_args:
-                unknown_args = ",".join(unknown_args)
-                raise HTTP(
-                    400, f"Unknown variables for search/{args[0]}: {unknown_args}"
+        if len(args) == 1 and args[0] in SEARCH_REGISTRY:
+            # Extract the shared query parameters and then validate the remaining query
+            # search parameters against the typed search function parameters
+            most_recent, ids = _parse_vars(vars)
+            limit, cursor = _parse_page_vars(vars)
+            stream = _parse_flag(vars, "stream")
+            facets = _parse_facets(vars)
+            search = SEARCH_REGISTRY[args[0]]
+
+            try:
+                search_args = search.coerce(vars)
+            except ValueError as e:
+                raise HTTP(400, str(e))
+
+            def _search():
+                qry = search.func(
+                    **search_args, **search.shared_args(most_recent, ids)
                 )
-            else:
-                try:
-                    qry = func(**vars)
-
-                    # does the function return a query or an error dictionary
-                    if isinstance(qry, dict):
-                        return qry
-                    else:
-                        most_recent, ids = _parse_vars(vars)
-                        return dataset_query_to_json(qry, most_recent, ids)
-                except TypeError as e:
-                    raise HTTP(400, f"Could not parse api request: {e}")
+
+                # does the function return a query or an error dictionary
+                if isinstance(qry, dict):
+                    return qry
+                else:
+                    return dataset_query_to_json(
+                        qry,
+                        most_recent,
+                        ids,
+                        limit=limit,
+                        cursor=cursor,
+                        stream=stream,
+                        facets=facets,
+                    )
+
+            try:
+                # Streamed results are not cached, to keep memory use bounded
+                if stream:
+                    val = _search()
+                    return val if isinstance(val, dict) else _stream_response(val)
+
+                key = SEARCH_CACHE.key(
+                    args[0], search_args, most_recent, ids, limit, cursor, facets
+                )
+                return SEARCH_CACHE.get(key, _search)
+            except TypeError as e:
+                raise HTTP(400, f"Could not parse api request: {e}")
+            except ValueError as e:
+                raise HTTP(400, str(e))
         elif len(args) == 0:
             raise HTTP(
                 400,
@@ -462,4 +678,68 @@ def search():
         else:
             raise HTTP(400, "Unknown arguments to search API.")
 
+    def POST(*args, **vars):
+        # The variables from a JSON request body are included in vars by web2py
+        return GET(*args, **vars)
+
+    return locals()
+
+
+@request.restful()
+def batch_search():
+    """Search for the datasets matching each of a batch of query geometries
+
+    This endpoint runs a spatial or bbox search for each of a list of query geometries
+    in a single request, rather than making a request for each geometry. The request
+    must be a POST request with a JSON body that is either a GeoJSON FeatureCollection
+    in WGS84 longitude and latitude or an object giving a list of gazetteer locations
+    in "location". The "distance" and, for bbox searches, "match_type" and "geometry"
+    variables are used as in the single geometry searches, and the shared
+    <code>ids</code> and <code>most_recent</code> variables can also be included.
+
+    The response gives the number of query geometries and then an entry for each
+    geometry, in the order provided, giving the index of the geometry, the feature id
+    or location name and the count and details of the datasets matching that geometry.
+
+    Example usage:
+        POST /api/batch_search/spatial.json?distance=100
+        {"type": "FeatureCollection", "features": [...]}
+
+        POST /api/batch_search/bbox.json
+        {"location": ["A_1", "B_1"], "match_type": "within"}
+    """
+    response.view = "generic.json"
+
+    def POST(*args, **vars):
+        if len(args) != 1 or args[0] not in ("spatial", "bbox"):
+            raise HTTP(400, "Provide one of the batch search types: spatial, bbox")
+
+        most_recent, ids = _parse_vars(vars)
+
+        # The body can be the FeatureCollection itself or give a list of locations
+        if vars.get("type") == "FeatureCollection":
+            features = {"type": "FeatureCollection", "features": vars.get("features")}
+        else:
+            features = vars.get("features")
+
+        location = vars.get("location")
+        if location is not None and not isinstance(location, list):
+            location = [location]
+
+        try:
+            distance = float(vars.get("distance", 0))
+        except (TypeError, ValueError):
+            raise HTTP(400, "Invalid distance value")
+
+        return dataset_batch_spatial_search(
+            args[0],
+            features=features,
+            location=location,
+            distance=distance,
+            match_type=vars.get("match_type", "intersect"),
+            geometry=vars.get("geometry", "extent"),
+            most_recent=most_recent,
+            ids=ids,
+        )
+
     return locals()
@@ -1,21 +1,20 @@
 """A controller to expose the gazetteer as a map."""
 
-from gluon.contrib import simplejson
-from gluon.serializers import json, loads_json
-
-import os
-from gpxpy import gpx
-
-
-SFIELDS = [
-    db.gazetteer.location,
-    # db.gazetteer.type,
-    # db.gazetteer.plot_size,
-    # db.gazetteer.fractal_order,
-    # db.gazetteer.transect_order,
-]
-"""This is a list of gazetteer table fields used for searching and download, and needs
-to be updated to the gazetteer table definition used by a particular project.
+from gluon.serializers import json
+
+from safedata_server_api import (
+    GAZETTEER_FIELDS,
+    export_gazetteer,
+    get_gazetteer,
+    get_gazetteer_export_file,
+    get_gazetteer_tile,
+)
+
+
+SFIELDS = [db.gazetteer[fld] for fld in GAZETTEER_FIELDS]
+"""This is a list of gazetteer table fields used for searching and download, which is
+set from GAZETTEER_FIELDS in the safedata_server_api module, and that needs to be
+updated to the gazetteer table definition used by a particular project.
 """
 
 
@@ -27,51 +26,49 @@ def index():
     """
 
     # If the grid has set up some search keywords, and the keywords aren't an empty
-    # string then use them to select those rows, otherwise get all rows
-
+    # string then use them to select those rows, otherwise get all rows. The map loads
+    # the locations from vector tiles, so only the names of any selected locations are
+    # passed to the map, to hide the other locations.
     if "keywords" in request.get_vars and request.vars.keywords != "":
         qry = SQLFORM.build_query(SFIELDS, keywords=request.vars.keywords)
+        selected = [rw.location for rw in db(qry).select(db.gazetteer.location)]
     else:
-        qry = db.gazetteer
-
-    # get the (selected) rows and turn them into geojson, ordering them
-    # so that the bottom ones get added to the leaflet map first
-    rws = db(qry).select(
-        db.gazetteer.ALL,
-        db.gazetteer.wkt_wgs84.st_asgeojson().with_alias("geojson"),
-        orderby=db.gazetteer.display_order,
-    )
+        selected = None
+
+    # Handle the GPX and GeoJSON exports here rather than in the grid, which would
+    # select the rows before they are exported. Exports of all locations are served
+    # from the files built when the gazetteer is updated.
+    export_type = request.vars._export_type
+    if export_type in EXPORT_CONTENT_TYPES:
+        filename = f"gazetteer.{export_type}"
+        response.headers["Content-Type"] = EXPORT_CONTENT_TYPES[export_type]
+
+        if selected is None:
+            try:
+                export_file = get_gazetteer_export_file(export_type)
+            except FileNotFoundError:
+                raise HTTP(404, "Gazetteer data not loaded")
+
+            return response.stream(
+                export_file, request=request, attachment=True, filename=filename
+            )
 
-    # Create tooltip text for the gazetteer
-    tooltips = ["<B>" + rw.gazetteer["location"] + "</B></BR>" for rw in rws]
+        response.headers["Content-Disposition"] = f"attachment;filename={filename};"
+        raise HTTP(200, export_gazetteer(export_type, selected), **response.headers)
 
-    rws = [
-        {"type": "Feature", "tooltip": tl, "geometry": loads_json(r.geojson)}
-        for r, tl in zip(rws, tooltips)
-    ]
+    # The gazetteer version is added to the tile URLs, so that browsers do not use
+    # cached tiles from previous versions
+    gazetteer = get_gazetteer()
+    version = None if gazetteer is None else gazetteer.hash[0]
 
-    # provide GPX and GeoJSON downloaders and use the magic 'with_hidden_cols' suffix to
-    # allow the Exporter to access fields that aren't shown in the table
-    export = dict(
-        gpx_with_hidden_cols=(ExporterGPX, "GPX"),
-        geojson_with_hidden_cols=(ExporterGeoJSON, "GeoJson"),
-        csv_with_hidden_cols=False,
-        csv=False,
-        xml=False,
-        html=False,
-        json=False,
-        tsv_with_hidden_cols=False,
-        tsv=False,
-    )
-
-    # hide display order from search and export
+    # hide display order from search
     db.gazetteer.display_order.readable = False
 
+    # The exports are handled above, so the grid export menu is not used
     form = SQLFORM.grid(
         db.gazetteer,
         fields=SFIELDS,
-        csv=True,
-        exportclasses=export,
+        csv=False,
         maxtextlength=250,
         deletable=False,
         editable=False,
@@ -79,128 +76,54 @@ def index():
         details=False,
     )
 
-    # format the HTML to move the export button into the search console
-    # get a button themed link. Check to make sure there is an export menu
-    # as it will be missing if a search returns no rows
-    exp_menu = form.element(".w2p_export_menu")
-    if exp_menu is not None:
+    # Add buttons to the search console to export the locations matching the search,
+    # checking that the grid includes the search console
+    console = form.element(".web2py_console form")
+    if console is not None:
         exp_gpx = A(
             "Export GPX",
             _class="btn btn-default",
-            _href=exp_menu[2].attributes["_href"],
+            _href=URL(vars=dict(request.get_vars, _export_type="gpx")),
             _style="padding:6px 12px;line-height:20px",
         )
         exp_geojson = A(
             "Export GeoJSON",
             _class="btn btn-default",
-            _href=exp_menu[1].attributes["_href"],
+            _href=URL(vars=dict(request.get_vars, _export_type="geojson")),
             _style="padding:6px 12px;line-height:20px",
         )
-        console = form.element(".web2py_console form")
         console.insert(len(console), CAT(exp_gpx, exp_geojson))
 
-        # get the existing export menu index (a DIV within FORM) and delete it
-        export_menu_idx = [x.attributes["_class"] for x in form].index(
-            "w2p_export_menu"
-        )
-        del form[export_menu_idx]
-
-    return dict(form=form, sitedata=json(rws))
-
+    return dict(form=form, selected=json(selected), version=version)
 
-class ExporterGPX(object):
 
+def tiles():
     """
-    Used to export a GPX file of the selected rows in SQLFORM grid
+    Controller to provide Mapbox Vector Tiles of the gazetteer locations for the map
+    view, using the URL /gazetteer/tiles/{z}/{x}/{y}.mvt
     """
 
-    file_ext = "gpx"
-    content_type = "text/xml"
-
-    def __init__(self, rows):
-        self.rows = rows
-
-    def export(self):
-        if self.rows:
-            # create a new gpx file
-            gpx_data = gpx.GPX()
+    if len(request.args) != 3:
+        raise HTTP(400, "Provide the tile zoom, x and y")
 
-            # exclude rows with no centroid data (polylines at present)
-            to_gpx = (rw for rw in self.rows if rw.centroid_x is not None)
+    try:
+        z, x, y = [int(arg.rsplit(".mvt", 1)[0]) for arg in request.args]
+    except ValueError:
+        raise HTTP(400, "Invalid tile coordinates")
 
-            # add the centroids into the file
-            for pt in to_gpx:
-                gpx_data.waypoints.append(
-                    gpx.GPXWaypoint(
-                        name=pt.location,
-                        longitude=pt.centroid_x,
-                        latitude=pt.centroid_y,
-                    )
-                )
+    try:
+        tile = get_gazetteer_tile(z, x, y)
+    except ValueError as err:
+        raise HTTP(400, str(err))
 
-            return gpx_data.to_xml()
-        else:
-            return ""
+    response.headers["Content-Type"] = "application/vnd.mapbox-vector-tile"
+    response.headers["Cache-Control"] = "public, max-age=3600"
 
+    return tile
 
-class ExporterGeoJSON(object):
-
-    """
-    Used to export a GPX file of the selected rows in SQLFORM grid
-    """
-
-    file_ext = "geojson"
-    content_type = "application/vnd.geo+json"
-
-    def __init__(self, rows):
-        self.rows = rows
-
-    def export(self):
-        if self.rows:
-
-            # get a list of dictionaries of the values
-            ft_as_dicts = list(self.rows.as_dict().values())
-
-            # pop out the geometry components and id
-            id_number = [ft.pop("id") for ft in ft_as_dicts]
-
-            # Get the locations - for geojson, we need an id, a geometry and a
-            # dictionary of properties. This query uses the with_alias() to strucure the
-            # results with id and geojson outside of the 'gazetteer' table dictionary,
-            # making it really simple to restucture them into a geojson Feature entry
-            locations = (
-                db(db.gazetteer.id.belongs(id_number))
-                .select(
-                    db.gazetteer.id.with_alias("id"),
-                    db.gazetteer.location,
-                    SFIELDS,
-                    db.gazetteer.wkt_wgs84.st_asgeojson().with_alias("geojson"),
-                )
-                .as_list()
-            )
 
-            # assemble the features list - postgres returns ST_AsGeoJSON as a string, so
-            # this has to be converted back into a dictionary.
-            features = [
-                {
-                    "type": "Feature",
-                    "id": loc["id"],
-                    "properties": loc["gazetteer"],
-                    "geometry": loads_json(loc["geojson"]),
-                }
-                for loc in locations
-            ]
-
-            # embed that in the Feature collection
-            feature_collection = {
-                "type": "FeatureCollection",
-                "crs": {
-                    "type": "name",
-                    "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"},
-                },
-                "features": features,
-            }
-
-            return simplejson.dumps(feature_collection)
-        else:
-            return ""
+# The content types of the gazetteer export formats
+EXPORT_CONTENT_TYPES = {
+    "gpx": "text/xml",
+    "geojson": "application/vnd.geo+json",
+}
@@ -155,6 +155,12 @@ db.define_table(
         "geographic_extent_local",
         f"geometry(public, {configuration.get('geo.local_epsg')}, 2)",
     ),
+    # The convex hull of the resolved location geometries, or the local extent for
+    # datasets without location geometries, maintained by update_location_resolution
+    Field(
+        "geographic_footprint_local",
+        f"geometry(public, {configuration.get('geo.local_epsg')}, 2)",
+    ),
     Field("temporal_extent_start", "date"),
     Field("temporal_extent_end", "date"),
     Field("dataset_history", "text"),
@@ -176,16 +182,42 @@ db.define_table(
     Field("keyword", "string"),
 )
 
+# The taxa table holds each distinct taxon used in datasets once, along with the number
+# of dataset records of the taxon, and the dataset_taxon_links table links datasets to
+# those taxa. Taxa are matched on all of the taxon fields, as taxa that are not found
+# in a taxonomic authority have no taxon id and the same taxon id can be used with
+# different names and statuses. The tables are maintained by insert_dataset_taxa in
+# the safedata_server_api module.
+
 db.define_table(
-    "dataset_taxa",
-    Field("dataset_id", "reference published_datasets"),
+    "taxa",
     Field("taxon_auth", "string"),
-    Field("worksheet_name", "string"),
     Field("taxon_id", "integer"),
     Field("parent_id", "integer"),
     Field("taxon_name", "string"),
     Field("taxon_rank", "string"),
     Field("taxon_status", "string"),
+    Field("n_datasets", "integer", default=0),
+)
+
+db.define_table(
+    "dataset_taxon_links",
+    Field("dataset_id", "reference published_datasets"),
+    Field("taxon", "reference taxa"),
+    Field("worksheet_name", "string"),
+)
+
+# The taxon closure table is derived from the taxa table and records every ancestor of
+# each taxon within a taxonomic authority, including the taxon itself at a depth of
+# zero, so that searches can find all of the descendants of a taxon. It is maintained
+# by update_taxon_closure in the safedata_server_api module.
+
+db.define_table(
+    "taxon_closure",
+    Field("taxon_auth", "string"),
+    Field("ancestor_id", "integer"),
+    Field("descendant_id", "integer"),
+    Field("depth", "integer"),
 )
 
 db.define_table(
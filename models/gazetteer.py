@@ -48,3 +48,41 @@ db.gazetteer_alias._before_insert.append(
         & (db.gazetteer_alias.alias == r["alias"])
     ).select()
 )
+
+
+"""
+Resolved dataset locations - this table maps each dataset location to its gazetteer
+location, applying aliases for the specific dataset and then general aliases. It holds
+the local geometry of the gazetteer location or, for new locations that are not in the
+gazetteer, the geometry provided in the dataset, so that location and spatial searches
+can use a single indexed table. For unresolved locations, the location field holds the
+dataset location name. The table is maintained by update_location_resolution when
+datasets are published and when the gazetteer is updated.
+"""
+
+db.define_table(
+    "dataset_location_resolved",
+    Field("dataset_id", "reference published_datasets"),
+    Field("location_id", "reference dataset_locations"),
+    Field("name", "string"),
+    Field("location", "string"),
+    Field("in_gazetteer", "boolean"),
+    Field("wkt_local", f"geometry(public, {configuration.get('geo.local_epsg')}, 2)"),
+)
+
+
+"""
+Dataset coverage - this table records the cells in a set of standard hexagonal and
+square grids that intersect the resolved locations of each dataset, identified by the
+PostGIS grid cell indices, and is used to provide coverage maps of datasets. The table
+is maintained with the resolved dataset locations by update_dataset_coverage.
+"""
+
+db.define_table(
+    "dataset_coverage",
+    Field("dataset_id", "reference published_datasets"),
+    Field("grid", "string"),
+    Field("cell_size", "integer"),
+    Field("cell_i", "integer"),
+    Field("cell_j", "integer"),
+)
@@ -0,0 +1,148 @@
+"""
+DATABASE INDEXES
+- The DAL table definitions cannot declare some of the PostgreSQL specific indexes used
+  to speed up searches, so these are created here using SQL statements.
+- The statements are idempotent, but are only run once per process and only when
+  migrations are enabled, using the RAM cache to record that they have been run.
+- The application refuses to start, other than from the web2py shell, until any
+  dataset taxa in the original dataset_taxa table have been converted using the
+  scripts/migrate_dataset_taxa.py script.
+- Tables derived from the published datasets are also populated here if they are
+  missing rows for existing data, so that they are filled in for datasets published
+  before they were added. Each table is checked for data it should hold, rather than
+  for being empty, as the tables can legitimately be empty.
+"""
+
+from safedata_server_api import (
+    update_location_resolution,
+    update_taxon_closure,
+)
+
+DB_INDEXES = [
+    # Trigram indexes for case insensitive and fuzzy name searches
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+    "CREATE INDEX IF NOT EXISTS dataset_authors_name_trgm "
+    "ON dataset_authors USING gin (name gin_trgm_ops);",
+    # GiST indexes on geometries for spatial searches and gazetteer map tiles
+    "CREATE INDEX IF NOT EXISTS gazetteer_wkt_local_gist "
+    "ON gazetteer USING gist (wkt_local);",
+    "CREATE INDEX IF NOT EXISTS gazetteer_wkt_wgs84_gist "
+    "ON gazetteer USING gist (wkt_wgs84);",
+    "CREATE INDEX IF NOT EXISTS published_datasets_extent_local_gist "
+    "ON published_datasets USING gist (geographic_extent_local);",
+    "CREATE INDEX IF NOT EXISTS published_datasets_footprint_local_gist "
+    "ON published_datasets USING gist (geographic_footprint_local);",
+    # Resolved dataset locations used by the location and spatial searches
+    "CREATE INDEX IF NOT EXISTS dataset_location_resolved_wkt_local_gist "
+    "ON dataset_location_resolved USING gist (wkt_local);",
+    "CREATE INDEX IF NOT EXISTS dataset_location_resolved_location_trgm "
+    "ON dataset_location_resolved USING gin (location gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS dataset_location_resolved_name_trgm "
+    "ON dataset_location_resolved USING gin (name gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS dataset_location_resolved_dataset_id "
+    "ON dataset_location_resolved (dataset_id);",
+    # Dataset coverage grid cells
+    "CREATE INDEX IF NOT EXISTS dataset_coverage_cells "
+    "ON dataset_coverage (grid, cell_size, cell_i, cell_j);",
+    "CREATE INDEX IF NOT EXISTS dataset_coverage_dataset_id "
+    "ON dataset_coverage (dataset_id);",
+    # Taxon hierarchy closure, used to find the descendants and ancestors of taxa, which
+    # holds each ancestor of a taxon once
+    "CREATE UNIQUE INDEX IF NOT EXISTS taxon_closure_unique "
+    "ON taxon_closure (taxon_auth, ancestor_id, descendant_id);",
+    "CREATE INDEX IF NOT EXISTS taxon_closure_descendant "
+    "ON taxon_closure (taxon_auth, descendant_id);",
+    # Taxa and the links from datasets to taxa, including taxon name prefix searches.
+    # Taxa are unique on the taxon fields, with nulls treated as equal by coalescing.
+    "CREATE UNIQUE INDEX IF NOT EXISTS taxa_unique "
+    "ON taxa (taxon_auth, taxon_name, COALESCE(taxon_id, -1), "
+    "COALESCE(parent_id, -1), COALESCE(taxon_rank, ''), COALESCE(taxon_status, ''));",
+    "CREATE INDEX IF NOT EXISTS taxa_taxon_id "
+    "ON taxa (taxon_auth, taxon_id);",
+    "CREATE INDEX IF NOT EXISTS taxa_name_prefix "
+    "ON taxa (LOWER(taxon_name) text_pattern_ops);",
+    "CREATE INDEX IF NOT EXISTS dataset_taxon_links_dataset_id "
+    "ON dataset_taxon_links (dataset_id);",
+    "CREATE INDEX IF NOT EXISTS dataset_taxon_links_taxon "
+    "ON dataset_taxon_links (taxon);",
+]
+
+
+def _create_indexes():
+    for statement in DB_INDEXES:
+        db.executesql(statement)
+
+    db.commit()
+    return True
+
+
+def _populate_derived_tables():
+    resolved = db.dataset_location_resolved
+    datasets = db.published_datasets
+
+    # Dataset locations without a resolved location
+    resolved_ids = db(resolved)._select(resolved.location_id)
+    unresolved = ~db.dataset_locations.id.belongs(resolved_ids)
+
+    # Datasets without a footprint that have an extent or resolved location geometries
+    located = db(resolved.wkt_local != None)._select(resolved.dataset_id)
+    no_footprint = (datasets.geographic_footprint_local == None) & (
+        (datasets.geographic_extent_local != None) | datasets.id.belongs(located)
+    )
+
+    # Resolved location geometries for datasets without coverage cells
+    covered = db(db.dataset_coverage)._select(db.dataset_coverage.dataset_id)
+    uncovered = (resolved.wkt_local != None) & ~resolved.dataset_id.belongs(covered)
+
+    # Resolving the locations also sets the dataset footprints and coverage
+    if not (
+        db(unresolved).isempty()
+        and db(no_footprint).isempty()
+        and db(uncovered).isempty()
+    ):
+        update_location_resolution()
+
+    # Taxa with a taxon id that are missing from the closure at depth zero
+    no_closure = db.executesql(
+        "SELECT EXISTS (SELECT 1 FROM taxa WHERE taxa.taxon_id IS NOT NULL "
+        "AND NOT EXISTS (SELECT 1 FROM taxon_closure "
+        "WHERE taxon_closure.taxon_auth = taxa.taxon_auth "
+        "AND taxon_closure.descendant_id = taxa.taxon_id "
+        "AND taxon_closure.depth = 0));"
+    )[0][0]
+
+    if no_closure:
+        update_taxon_closure()
+
+    db.commit()
+    return True
+
+
+def _check_taxa_migrated():
+    # Datasets in the original dataset_taxa table without links to the taxa table have
+    # not been converted, so the taxa endpoints and searches would miss their taxa.
+    if db.executesql("SELECT to_regclass('dataset_taxa');")[0][0] is None:
+        return True
+
+    unconverted = db.executesql(
+        "SELECT EXISTS (SELECT 1 FROM dataset_taxa WHERE NOT EXISTS "
+        "(SELECT 1 FROM dataset_taxon_links "
+        "WHERE dataset_taxon_links.dataset_id = dataset_taxa.dataset_id));"
+    )[0][0]
+
+    if unconverted:
+        raise RuntimeError(
+            "Dataset taxa have not been converted to the taxa table: "
+            "run scripts/migrate_dataset_taxa.py"
+        )
+
+    return True
+
+
+# The check is skipped in the web2py shell, which is used to run the conversion
+if not request.is_shell:
+    cache.ram("taxa_migrated", _check_taxa_migrated, time_expire=None)
+
+if configuration.get("db.migrate"):
+    cache.ram("db_indexes", _create_indexes, time_expire=None)
+    cache.ram("db_derived_tables", _populate_derived_tables, time_expire=None)
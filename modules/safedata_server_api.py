@@ -1,11 +1,29 @@
+from collections import OrderedDict, namedtuple
 from csv import DictReader
+from functools import lru_cache
 from io import StringIO
+import base64
+import inspect
 import os
 import datetime
 import hashlib
 import json
-
-from shapely.geometry import box, shape
+import re
+import shutil
+import threading
+import time
+import typing
+import weakref
+
+from gpxpy import gpx
+from pyproj import Transformer
+import shapely
+from shapely import wkb as shapely_wkb
+from shapely import wkt as shapely_wkt
+from shapely.errors import ShapelyError
+from shapely.geometry import box, mapping, shape
+from shapely.ops import transform, unary_union
+from shapely.strtree import STRtree
 
 # The web2py HTML helpers are provided by gluon. This also provides the 'current'
 # object, which provides the web2py 'request' API (note the single letter difference
@@ -14,8 +32,418 @@ from shapely.geometry import box, shape
 # accessed by this module
 
 from gluon import current
+from gluon.http import HTTP
+from gluon.dal import Expression, Query
 from gluon.serializers import json as web2py_json
 
+# Search functions return a Query, or an error dictionary, but can also return a
+# RankedQuery that bundles the Query with an expression used to rank matching datasets,
+# such as a trigram similarity score, along with the name used for the rank in the
+# results and whether datasets are ranked by ascending values, such as distances.
+RankedQuery = namedtuple(
+    "RankedQuery",
+    ["query", "rank", "name", "ascending"],
+    defaults=["similarity", False],
+)
+
+# The number of rows fetched from the database and written out together when streaming
+# JSON responses.
+STREAM_CHUNK_SIZE = 1000
+
+# The maximum number of dedicated database connections used by each process to stream
+# responses. Further streamed responses wait for a connection to be released for up to
+# STREAM_CONNECTION_TIMEOUT seconds, and then fail with a 503 error.
+STREAM_MAX_CONNECTIONS = 4
+STREAM_CONNECTION_TIMEOUT = 10
+
+# The fields identifying a taxon in the taxa table.
+TAXON_FIELDS = [
+    "taxon_auth",
+    "taxon_id",
+    "parent_id",
+    "taxon_name",
+    "taxon_rank",
+    "taxon_status",
+]
+
+# The SQL values replacing nulls in the taxon fields when taxa are matched, which are
+# the same as those used in the taxa_unique index on the taxa table.
+TAXON_FIELD_NULLS = {
+    "taxon_id": "-1",
+    "parent_id": "-1",
+    "taxon_rank": "''",
+    "taxon_status": "''",
+}
+
+# The maximum depth of the taxon hierarchy, which stops the taxon closure from looping
+# if the recorded parent ids ever contain a cycle.
+TAXON_MAX_DEPTH = 100
+
+# The maximum number of search results held in the search result cache.
+SEARCH_CACHE_SIZE = 256
+
+# The maximum total size in bytes of the JSON for the results in the search result
+# cache. Results larger than a quarter of this size are not cached.
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# The interval in seconds between checks of the database for data posted by other
+# processes, which clears the search results cached in this process.
+SEARCH_CACHE_VERSION_INTERVAL = 5
+
+# The facets that can be counted for the datasets matching a search. Each facet gives
+# the SQL for the facet value, the tables providing the value and the field linking
+# those tables to the matching dataset ids.
+SEARCH_FACETS = OrderedDict(
+    rank=(
+        "taxa.taxon_rank",
+        "dataset_taxon_links JOIN taxa ON taxa.id = dataset_taxon_links.taxon",
+        "dataset_taxon_links.dataset_id",
+    ),
+    taxon=(
+        "taxa.taxon_name",
+        "dataset_taxon_links JOIN taxa ON taxa.id = dataset_taxon_links.taxon",
+        "dataset_taxon_links.dataset_id",
+    ),
+    author=("dataset_authors.name", "dataset_authors", "dataset_authors.dataset_id"),
+    field_type=(
+        "dataset_fields.field_type",
+        "dataset_fields",
+        "dataset_fields.dataset_id",
+    ),
+    access=(
+        "published_datasets.dataset_access",
+        "published_datasets",
+        "published_datasets.id",
+    ),
+    year=(
+        "EXTRACT(YEAR FROM published_datasets.publication_date)",
+        "published_datasets",
+        "published_datasets.id",
+    ),
+    location=(
+        "CASE WHEN dataset_location_resolved.in_gazetteer = 'T' "
+        "THEN dataset_location_resolved.location END",
+        "dataset_location_resolved",
+        "dataset_location_resolved.dataset_id",
+    ),
+)
+
+# The maximum number of values, with the most datasets, returned for each facet.
+FACET_SIZE = 100
+
+# The grid types and cell sizes, in metres in the local projection, for which the grid
+# cells containing dataset locations are precomputed for coverage maps. The grid types
+# give the PostGIS functions for the grid cells covering a geometry and for a cell.
+COVERAGE_GRIDS = OrderedDict(
+    hex=("ST_HexagonGrid", "ST_Hexagon"), square=("ST_SquareGrid", "ST_Square")
+)
+COVERAGE_CELL_SIZES = (1000, 5000, 25000)
+
+# The simplified levels of detail of the gazetteer GeoJSON for lightweight clients,
+# giving the tolerance in degrees used to simplify the location geometries, preserving
+# their topology, and the decimal places kept in the coordinates. The full detail is
+# the gazetteer GeoJSON as posted to the server.
+GAZETTEER_DETAIL = OrderedDict(high=(0.00001, 5), medium=(0.0001, 4), low=(0.001, 3))
+
+# The gazetteer table fields used for searching the gazetteer and included in gazetteer
+# exports, which need to be updated to the gazetteer table definition used by a project.
+GAZETTEER_FIELDS = [
+    "location",
+    # "type",
+    # "plot_size",
+    # "fractal_order",
+    # "transect_order",
+]
+
+# The gazetteer export formats and the files holding the export of all locations.
+GAZETTEER_EXPORTS = OrderedDict(
+    gpx="gazetteer_export.gpx", geojson="gazetteer_export.geojson"
+)
+
+# The maximum zoom level of the gazetteer map vector tiles and the maximum zoom level
+# of tiles cached on disk. Higher zoom tiles are rendered on each request, but the map
+# overzooms tiles from the maximum cached zoom level.
+GAZETTEER_TILE_MAX_ZOOM = 22
+GAZETTEER_TILE_CACHE_MAX_ZOOM = 14
+
+# The maximum number of geometries that can be used in a batch spatial search.
+BATCH_SEARCH_MAX_FEATURES = 1000
+
+# The maximum number of datasets that can be requested from the nearest search.
+NEAREST_MAX_K = 1000
+
+# The maximum number of parsed and projected WKT query geometries held in memory.
+QUERY_GEOMETRY_CACHE_SIZE = 256
+
+# The maximum number of prepared statements kept on each database connection.
+PREPARED_STATEMENT_LIMIT = 128
+
+# Tokens in the SQL statements built by PyDAL: quoted identifiers, which are left
+# unchanged, and escaped strings, strings and numbers, which are the literal values that
+# become the parameters of prepared statements.
+SQL_TOKENS = re.compile(
+    r'"(?:[^"]|"")*"'
+    r"|(?<![\w$])[Ee]'(?:[^'\\]|''|\\.)*'"
+    r"|'(?:[^']|'')*'"
+    r"|(?<![\w$.])\d+(?:\.\d+)?(?:[Ee][-+]?\d+)?(?![\w.])"
+)
+
+
+class SearchCache:
+    """A bounded, least recently used cache of search results.
+
+    Results are stored under a key built from the normalised search request. If a
+    request arrives for a key that is already being computed by another thread, it
+    waits for and shares that result rather than running the same search again.
+
+    The cache is held in the memory of each web2py process, in the same way as the RAM
+    cache of the metadata index, and is cleared by the process that posts new metadata
+    or gazetteer data, once that data is committed. Other processes check a version of
+    the data in the database, using the latest published dataset and gazetteer ids
+    which only increase when new data is posted, at most every
+    SEARCH_CACHE_VERSION_INTERVAL seconds and clear their cache when they see a new
+    version. Results computed while the cache is being cleared are not stored, and
+    error responses are never stored. The cache is limited both in the number of
+    results and in the total size of the results.
+    """
+
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE, maxbytes=SEARCH_CACHE_MAX_BYTES):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._results = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._pending = {}
+        self._generation = 0
+        self._version = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def version(self):
+        """
+        Get the data version, reading it from the database if it has not been checked
+        within SEARCH_CACHE_VERSION_INTERVAL seconds, and clear the cache if the version
+        is newer than the version of the cached results.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if (
+                self._checked is not None
+                and now - self._checked < SEARCH_CACHE_VERSION_INTERVAL
+            ):
+                return self._version
+
+        version = tuple(
+            0 if vl is None else vl
+            for vl in current.db.executesql(
+                "SELECT (SELECT MAX(id) FROM published_datasets), "
+                "(SELECT MAX(id) FROM gazetteer), "
+                "(SELECT MAX(id) FROM gazetteer_alias);"
+            )[0]
+        )
+
+        with self._lock:
+            newer = self._version is None or version > self._version
+
+        if newer:
+            self.clear()
+
+        with self._lock:
+            if newer:
+                self._version = version
+            self._checked = now
+
+        return version
+
+    def key(self, search_type, args, *shared):
+        """
+        Build a cache key from the data version, a search type, its arguments and
+        shared options.
+        """
+
+        def _normalise(value):
+            if isinstance(value, (list, tuple, set)):
+                return tuple(sorted(str(vl) for vl in value))
+            return value
+
+        return (
+            self.version(),
+            search_type,
+            tuple(sorted((ky, _normalise(vl)) for ky, vl in args.items())),
+            tuple(_normalise(vl) for vl in shared),
+        )
+
+    @staticmethod
+    def _size(result):
+        """Get the approximate size of a result, as the length of its JSON."""
+
+        if isinstance(result, str):
+            return len(result)
+        elif isinstance(result, tuple):
+            return sum(SearchCache._size(vl) for vl in result)
+
+        return len(web2py_json(result))
+
+    def get(self, key, func):
+        """Get the result for a key, calling func to compute it if needed."""
+
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = dict(
+                    event=threading.Event(), generation=self._generation
+                )
+                owner = True
+            else:
+                owner = False
+
+        # Wait for the thread already running this search
+        if not owner:
+            pending["event"].wait()
+            if "error" in pending:
+                raise pending["error"]
+            return pending["result"]
+
+        try:
+            pending["result"] = result = func()
+        except Exception as err:
+            pending["error"] = err
+            raise
+        else:
+            # Error responses from search functions are returned but never stored
+            if isinstance(result, dict) and "error" in result:
+                return result
+
+            size = self._size(result)
+            with self._lock:
+                if pending["generation"] == self._generation and (
+                    size <= self.maxbytes // 4
+                ):
+                    self._results[key] = result
+                    self._sizes[key] = size
+                    self._bytes += size
+                    while (
+                        len(self._results) > self.maxsize
+                        or self._bytes > self.maxbytes
+                    ):
+                        old_key, _ = self._results.popitem(last=False)
+                        self._bytes -= self._sizes.pop(old_key)
+        finally:
+            with self._lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+            pending["event"].set()
+
+        return result
+
+    def clear(self):
+        """
+        Clear all cached results, and check the data version again for the next search.
+        """
+
+        with self._lock:
+            self._results.clear()
+            self._sizes.clear()
+            self._bytes = 0
+            self._pending.clear()
+            self._generation += 1
+            self._checked = None
+
+
+SEARCH_CACHE = SearchCache()
+
+
+class PreparedStatements:
+    """Server-side prepared statements for the SQL used to run searches.
+
+    PyDAL builds SQL statements with the query values included as literals. This class
+    replaces those literals with parameters, so that searches that differ only in their
+    values share a statement template, and each template is prepared once on each
+    database connection. Running the statement then only needs the values, skipping
+    parsing and planning the statement on the database server.
+
+    Prepared statements belong to a database session, so the statements prepared on
+    each connection in the pool are tracked separately and are deallocated if there
+    are too many of them. If a template cannot be prepared, for example because the
+    database cannot infer the type of a parameter, the SQL is run directly instead.
+    Numbers are also replaced by parameters, so statements should not refer to columns
+    by position, as in ORDER BY 1.
+    """
+
+    def __init__(self, maxsize=PREPARED_STATEMENT_LIMIT):
+        self.maxsize = maxsize
+        self._prepared = weakref.WeakKeyDictionary()
+        self._unprepared = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parameterise(sql):
+        """
+        Split SQL into a template, with numbered parameters replacing the literal
+        values, and a list of those literal values. The types of the parameters are
+        inferred from the template by the database, in the same way as literals.
+        """
+
+        literals = []
+
+        def _replace(match):
+            token = match.group(0)
+            if token.startswith('"'):
+                return token
+
+            literals.append(token)
+            return f"${len(literals)}"
+
+        template = SQL_TOKENS.sub(_replace, sql.strip().rstrip(";"))
+
+        return template, literals
+
+    def executesql(self, sql):
+        """Run a SQL statement as a prepared statement, returning the rows."""
+
+        db = current.db
+        template, literals = self.parameterise(sql)
+        name = "safedata_" + hashlib.md5(template.encode("utf-8")).hexdigest()
+        connection = db._adapter.connection
+
+        with self._lock:
+            if template in self._unprepared:
+                return db.executesql(sql)
+            prepared = self._prepared.setdefault(connection, set())
+
+        if name not in prepared:
+            if len(prepared) >= self.maxsize:
+                db.executesql("DEALLOCATE ALL;")
+                prepared.clear()
+
+            # A failed statement aborts the transaction, so the statement is prepared
+            # within a savepoint that can be rolled back.
+            db.executesql("SAVEPOINT safedata_prepare;")
+
+            try:
+                db.executesql(f"PREPARE {name} AS {template};")
+            except (db._adapter.driver.ProgrammingError, db._adapter.driver.DataError):
+                db.executesql("ROLLBACK TO SAVEPOINT safedata_prepare;")
+                with self._lock:
+                    self._unprepared.add(template)
+                return db.executesql(sql)
+
+            db.executesql("RELEASE SAVEPOINT safedata_prepare;")
+            prepared.add(name)
+
+        if not literals:
+            return db.executesql(f"EXECUTE {name};")
+
+        return db.executesql(f"EXECUTE {name} ({', '.join(literals)});")
+
+
+PREPARED_STATEMENTS = PreparedStatements()
+
 
 def get_index():
 
@@ -60,6 +488,14 @@ def get_index():
     with open(gazetteer_file) as f:
         gazetteer_hash = hashlib.md5(f.read().encode("utf-8")).hexdigest()
 
+    # And the hashes of the simplified gazetteer files
+    gazetteer_detail_hashes = {}
+    for detail in GAZETTEER_DETAIL:
+        with open(get_gazetteer_file(detail)) as f:
+            gazetteer_detail_hashes[detail] = hashlib.md5(
+                f.read().encode("utf-8")
+            ).hexdigest()
+
     # Use the file hash of the static locations alias csv
     location_aliases_file = os.path.join(
         current.request.folder, "static", "files", "gis", "location_aliases.csv"
@@ -71,12 +507,186 @@ def get_index():
         hashes=dict(
             index=index_hash,
             gazetteer=gazetteer_hash,
+            gazetteer_detail=gazetteer_detail_hashes,
             location_aliases=location_aliases_hash,
         ),
         index=val,
     )
 
 
+def _record_json():
+    """
+    Shared function to give an expression for the metadata of a dataset record as JSON
+    text. The publication date and Zenodo ids are added to the stored metadata in the
+    database, so that the metadata, which can be large, is passed through as text
+    without being decoded and encoded again. The publication date uses the same format
+    as web2py JSON responses.
+    """
+
+    db = current.db
+    expand = db._adapter.expand
+    record = db.published_datasets
+
+    def _json(first, query_env={}):
+        return (
+            "CAST(COALESCE(CAST(%s AS JSONB), '{}') || jsonb_build_object("
+            "'publication_date', to_char(%s, 'YYYY-MM-DD HH24:MI:SS'), "
+            "'zenodo_concept_id', %s, 'zenodo_record_id', %s) AS TEXT)"
+            % tuple(
+                expand(fld, query_env=query_env)
+                for fld in (
+                    first,
+                    record.publication_date,
+                    record.zenodo_concept_id,
+                    record.zenodo_record_id,
+                )
+            )
+        )
+
+    return Expression(db, _json, record.dataset_metadata, None, "text").with_alias(
+        "record_json"
+    )
+
+
+def get_record(record_id):
+    """
+    Function to get the metadata for a dataset record, from the Zenodo record id, as a
+    JSON string, or None if the record is not found.
+    """
+
+    db = current.db
+    record_json = _record_json()
+
+    row = (
+        db(db.published_datasets.zenodo_record_id == record_id)
+        .select(record_json)
+        .first()
+    )
+
+    return None if row is None else row[record_json]
+
+
+def get_records(ids=None, most_recent=False):
+    """
+    Function to get the metadata for many dataset records, returning a generator that
+    streams a JSON array of the record metadata, in the same format as get_record,
+    sorted by Zenodo record id. The records can be restricted to a list of Zenodo
+    record ids and to the most recent versions of datasets, and all records are
+    returned if neither is given. The metadata is streamed as the JSON text from the
+    database.
+    """
+
+    db = current.db
+    qry = db.published_datasets.id > 0
+
+    if ids is not None:
+        qry &= _match_any(db.published_datasets.zenodo_record_id, ids)
+
+    if most_recent:
+        qry &= db.published_datasets.most_recent == True
+
+    _, rows = iter_select(
+        db(qry), _record_json(), orderby=db.published_datasets.zenodo_record_id
+    )
+
+    return stream_json((row["record_json"] for row in rows), encoded=True)
+
+
+def get_taxa(
+    limit=None, cursor=None, stream=False, auth=None, rank=None, name=None
+):
+    """
+    Function to summarise the taxa recorded in datasets, returning a list of the
+    details of each taxon and a count of the number of datasets recording it, from the
+    taxa table. The taxa can be filtered to lists of taxonomic authorities
+    and ranks and to taxon names starting with a case insensitive prefix, and are
+    sorted on the taxon fields. If a limit or cursor is provided, this returns a page of
+    taxa, along with the total count of taxa and the cursor for the next page. If
+    stream is True, this returns a generator that streams the same JSON content.
+    """
+
+    db = current.db
+    taxon_fields = [
+        db.taxa.taxon_auth,
+        db.taxa.taxon_id,
+        db.taxa.taxon_rank,
+        db.taxa.taxon_name,
+        db.taxa.taxon_status,
+        db.taxa.parent_id,
+    ]
+
+    # The taxon fields can contain nulls, which are replaced in the sort keys to give
+    # a complete and stable sort order
+    key_nulls = [-1 if fld.type == "integer" else "" for fld in taxon_fields]
+    taxon_keys = [fld.coalesce(nl) for fld, nl in zip(taxon_fields, key_nulls)]
+
+    taxon_count = [db.taxa.n_datasets]
+
+    taxa = db(db.taxa)
+
+    if auth is not None:
+        taxa = taxa(_match_any(db.taxa.taxon_auth, auth))
+
+    if rank is not None:
+        taxa = taxa(
+            _match_any(db.taxa.taxon_rank, [rk.lower() for rk in rank])
+        )
+
+    if name is not None:
+        taxa = taxa(db.taxa.taxon_name.lower().startswith(name.lower()))
+
+    # Count the total taxa in a separate query for paged results
+    paged = limit is not None or cursor is not None
+
+    if paged:
+        count_sql = taxa._count()
+
+    if cursor is not None:
+        taxa = taxa(_keyset_query(taxon_keys, decode_cursor(cursor, taxon_keys)))
+
+    select_args = dict(
+        orderby=taxon_keys,
+        limitby=None if limit is None else (0, limit + 1),
+    )
+
+    def _make_cursor(txn):
+        return encode_cursor(
+            [
+                nl if txn[fld.name] is None else txn[fld.name]
+                for fld, nl in zip(taxon_fields, key_nulls)
+            ]
+        )
+
+    if stream:
+        count, rows = iter_select(
+            taxa,
+            *taxon_fields + taxon_count,
+            count_sql=count_sql if paged else None,
+            **select_args,
+        )
+        return _stream_entries(
+            rows, count=count, limit=limit, make_cursor=_make_cursor
+        )
+
+    if paged:
+        count = db.executesql(count_sql)[0][0]
+
+    rows = taxa.select(*taxon_fields + taxon_count, **select_args)
+
+    # repackage the Rows to provide a flat json per taxon format.
+    val = [rw.as_dict() for rw in rows]
+
+    if not paged:
+        return val
+
+    next_cursor = None
+    if limit is not None and len(val) > limit:
+        val = val[:limit]
+        next_cursor = _make_cursor(val[-1])
+
+    return {"count": count, "entries": val, "next_cursor": next_cursor}
+
+
 def server_post_metadata(payload: dict) -> int:
     """Populate the dataset tables from posted metadata.
 
@@ -135,12 +745,12 @@ def server_post_metadata(payload: dict) -> int:
     # populate index tables
     # A) Taxa
     taxa = dataset["gbif_taxa"]
-    [tx.update({"dataset_id": published_record, "taxon_auth": "GBIF"}) for tx in taxa]
-    db.dataset_taxa.bulk_insert(taxa)
+    [tx.update({"taxon_auth": "GBIF"}) for tx in taxa]
+
+    ncbi_taxa = dataset["ncbi_taxa"]
+    [tx.update({"taxon_auth": "NCBI"}) for tx in ncbi_taxa]
 
-    taxa = dataset["ncbi_taxa"]
-    [tx.update({"dataset_id": published_record, "taxon_auth": "NCBI"}) for tx in taxa]
-    db.dataset_taxa.bulk_insert(taxa)
+    insert_dataset_taxa(published_record, taxa + ncbi_taxa)
 
     # B) Files, using the Zenodo response
     files = zenodo["files"]
@@ -162,6 +772,9 @@ def server_post_metadata(payload: dict) -> int:
         wkt_local=db.dataset_locations.wkt_wgs84.st_transform(32650)
     )
 
+    # resolve the locations against the gazetteer and aliases
+    update_location_resolution(published_record)
+
     # D) Dataworksheets and fields
     for data in dataset["dataworksheets"]:
 
@@ -192,13 +805,211 @@ def server_post_metadata(payload: dict) -> int:
         for kywd in dataset["keywords"]:
             db.dataset_keywords.insert(dataset_id=published_record, keyword=kywd)
 
-    # Update the index
+    # Update the index. The publication is committed by the post_metadata controller,
+    # which then clears the cached search results.
     current.cache.ram.clear("index")
     current.cache.ram("index", get_index, time_expire=None)
 
     return published_record
 
 
+def update_taxon_closure(dataset_id=None):
+    """Update the taxon hierarchy closure table.
+
+    The taxon_closure table records every ancestor of each taxon within a taxonomic
+    authority, including the taxon itself at depth zero, using the taxon and parent ids
+    recorded in the taxa table. This allows the taxa search to find all of the
+    descendants of a taxon using a single indexed join.
+
+    If no dataset id is provided, the table is rebuilt from all dataset taxa. Otherwise,
+    the new ancestors are added for the taxa in that dataset and for the existing
+    descendants of those taxa, which may now have a longer known ancestry.
+
+    Args:
+        dataset_id: An optional published_datasets id.
+    """
+
+    db = current.db
+
+    if dataset_id is None:
+        db.taxon_closure.truncate()
+        where, placeholders = "", (TAXON_MAX_DEPTH,)
+    else:
+        # Start from the dataset taxa and the taxa below them in the hierarchy
+        dataset_taxa = (
+            "(taxa JOIN dataset_taxon_links ON dataset_taxon_links.taxon = taxa.id "
+            "AND dataset_taxon_links.dataset_id = %s)"
+        )
+        where = (
+            "AND ((taxon_edges.taxon_auth, taxon_edges.taxon_id) IN "
+            f"(SELECT taxa.taxon_auth, taxa.taxon_id FROM {dataset_taxa}) "
+            "OR (taxon_edges.taxon_auth, taxon_edges.taxon_id) IN "
+            "(SELECT taxon_closure.taxon_auth, taxon_closure.descendant_id "
+            f"FROM taxon_closure JOIN {dataset_taxa} "
+            "ON taxa.taxon_auth = taxon_closure.taxon_auth "
+            "AND taxa.taxon_id = taxon_closure.ancestor_id))"
+        )
+        placeholders = (dataset_id, dataset_id, TAXON_MAX_DEPTH)
+
+    # Walk up the parent ids from each starting taxon and add any new ancestors
+    db.executesql(
+        "WITH RECURSIVE taxon_edges AS ("
+        "SELECT DISTINCT taxa.taxon_auth, taxa.taxon_id, taxa.parent_id FROM taxa "
+        "WHERE taxa.taxon_id IS NOT NULL), "
+        "ancestors (taxon_auth, ancestor_id, descendant_id, depth) AS ("
+        "SELECT taxon_edges.taxon_auth, taxon_edges.taxon_id, taxon_edges.taxon_id, 0 "
+        f"FROM taxon_edges WHERE TRUE {where} "
+        "UNION SELECT ancestors.taxon_auth, taxon_edges.parent_id, "
+        "ancestors.descendant_id, ancestors.depth + 1 "
+        "FROM ancestors JOIN taxon_edges "
+        "ON taxon_edges.taxon_auth = ancestors.taxon_auth "
+        "AND taxon_edges.taxon_id = ancestors.ancestor_id "
+        "WHERE taxon_edges.parent_id IS NOT NULL AND ancestors.depth < %s) "
+        "INSERT INTO taxon_closure (taxon_auth, ancestor_id, descendant_id, depth) "
+        "SELECT DISTINCT ancestors.taxon_auth, ancestors.ancestor_id, "
+        "ancestors.descendant_id, ancestors.depth FROM ancestors "
+        "ON CONFLICT DO NOTHING;",
+        placeholders=placeholders,
+    )
+
+
+def insert_dataset_taxa(dataset_id, taxa):
+    """Insert the taxa recorded in a published dataset.
+
+    Each taxon is added to the taxa table, if it is not already present, and linked to
+    the dataset in the dataset_taxon_links table. The dataset counts for the taxa and
+    the taxon hierarchy in the taxon_closure table are then updated.
+
+    Args:
+        dataset_id: A published_datasets id.
+        taxa: A list of dictionaries of the taxon fields and worksheet name for each
+            taxon recorded in the dataset.
+    """
+
+    db = current.db
+
+    if taxa:
+        # The taxa are matched to the taxa table in SQL using a VALUES list, with the
+        # taxon ids cast to integers as they may all be null.
+        values = ", ".join(
+            ["(%s, CAST(%s AS INTEGER), CAST(%s AS INTEGER), %s, %s, %s, %s)"]
+            * len(taxa)
+        )
+        new_taxa = (
+            f"(VALUES {values}) AS new_taxa "
+            f"({', '.join(TAXON_FIELDS)}, worksheet_name)"
+        )
+        placeholders = [
+            tx.get(fld) for tx in taxa for fld in TAXON_FIELDS + ["worksheet_name"]
+        ]
+        fields = ", ".join(f"new_taxa.{fld}" for fld in TAXON_FIELDS)
+
+        # The unique index on the taxon fields stops concurrent publications adding
+        # the same taxon twice
+        db.executesql(
+            f"INSERT INTO taxa ({', '.join(TAXON_FIELDS)}, n_datasets) "
+            f"SELECT DISTINCT {fields}, 0 FROM {new_taxa} ON CONFLICT DO NOTHING;",
+            placeholders=placeholders,
+        )
+
+        db.executesql(
+            "INSERT INTO dataset_taxon_links (dataset_id, taxon, worksheet_name) "
+            f"SELECT %s, taxa.id, new_taxa.worksheet_name FROM {new_taxa} "
+            f"JOIN taxa ON {_match_taxa('new_taxa')};",
+            placeholders=[dataset_id] + placeholders,
+        )
+
+        db.executesql(
+            "UPDATE taxa SET n_datasets = taxa.n_datasets + new_links.n_datasets "
+            "FROM (SELECT dataset_taxon_links.taxon, COUNT(*) AS n_datasets "
+            "FROM dataset_taxon_links WHERE dataset_taxon_links.dataset_id = %s "
+            "GROUP BY dataset_taxon_links.taxon) AS new_links "
+            "WHERE taxa.id = new_links.taxon;",
+            placeholders=(dataset_id,),
+        )
+
+    update_taxon_closure(dataset_id)
+
+
+def _match_taxa(table):
+    """
+    Shared function to give the SQL condition matching rows in a table of taxon fields
+    to the taxa table. The taxon names and authorities are always set, so are matched
+    using equality. The other fields can be null, so are matched using the same null
+    replacements as the taxa_unique index, so that taxa are matched exactly when they
+    would conflict in that index.
+    """
+
+    conditions = []
+    for fld in TAXON_FIELDS:
+        if fld in TAXON_FIELD_NULLS:
+            null = TAXON_FIELD_NULLS[fld]
+            conditions.append(
+                f"COALESCE(taxa.{fld}, {null}) = COALESCE({table}.{fld}, {null})"
+            )
+        else:
+            conditions.append(f"taxa.{fld} = {table}.{fld}")
+
+    return " AND ".join(conditions)
+
+
+def migrate_dataset_taxa():
+    """Convert the dataset taxa from the original dataset_taxa table.
+
+    The taxa for datasets were originally stored in a single dataset_taxa table, which
+    repeated the taxon details for each dataset. This copies the distinct taxa into the
+    taxa table and the dataset records into the dataset_taxon_links table, for datasets
+    that do not already have links, and then rebuilds the dataset counts and the taxon
+    hierarchy. The original table is left in place. This is run using the
+    scripts/migrate_dataset_taxa.py script.
+
+    Returns:
+        The number of dataset_taxa rows converted.
+    """
+
+    db = current.db
+
+    if db.executesql("SELECT to_regclass('dataset_taxa');")[0][0] is None:
+        raise RuntimeError("The dataset_taxa table does not exist")
+
+    # Datasets may already have been converted or published to the new tables, so
+    # only the rows for datasets without links are converted.
+    unlinked = (
+        "(SELECT * FROM dataset_taxa WHERE NOT EXISTS "
+        "(SELECT 1 FROM dataset_taxon_links "
+        "WHERE dataset_taxon_links.dataset_id = dataset_taxa.dataset_id)) "
+        "AS dataset_taxa"
+    )
+
+    n_original = db.executesql(f"SELECT COUNT(*) FROM {unlinked};")[0][0]
+
+    fields = ", ".join(TAXON_FIELDS)
+    db.executesql(
+        f"INSERT INTO taxa ({fields}, n_datasets) "
+        f"SELECT DISTINCT {fields}, 0 FROM {unlinked} ON CONFLICT DO NOTHING;"
+    )
+
+    n_linked = db.executesql(
+        "WITH links AS (INSERT INTO dataset_taxon_links "
+        "(dataset_id, taxon, worksheet_name) "
+        "SELECT dataset_taxa.dataset_id, taxa.id, dataset_taxa.worksheet_name "
+        f"FROM {unlinked} JOIN taxa ON {_match_taxa('dataset_taxa')} RETURNING 1) "
+        "SELECT COUNT(*) FROM links;"
+    )[0][0]
+
+    if n_linked != n_original:
+        raise RuntimeError("Could not link all of the dataset_taxa rows to taxa")
+
+    db.executesql(
+        "UPDATE taxa SET n_datasets = (SELECT COUNT(*) FROM dataset_taxon_links "
+        "WHERE dataset_taxon_links.taxon = taxa.id);"
+    )
+
+    update_taxon_closure()
+
+    return n_linked
+
+
 def server_update_gazetteer(payload: dict) -> None:
     """Update the gazetteer data used by the server
 
@@ -262,14 +1073,28 @@ def server_update_gazetteer(payload: dict) -> None:
         db.rollback()
         raise ValueError("Could not load location alias data")
 
-    # Write the files to static
+    # Resolve all dataset locations against the updated gazetteer and aliases
+    update_location_resolution()
+
+    # Prebuild the exports of all gazetteer locations before the commit, so that a
+    # failure to write the exports does not report an error for a committed update
     gaz_dir = os.path.join(current.request.folder, "static", "files", "gis")
     os.makedirs(gaz_dir, exist_ok=True)
+    write_gazetteer_exports(gaz_dir)
+
+    # Now if all is well, allow those updates to be committed, and then clear cached
+    # search results, so that results read before the commit are not kept
+    db.commit()
+    SEARCH_CACHE.clear()
 
+    # Write the files to static after the commit, so that the gazetteer hash used to
+    # cache tiles and other data only changes once the new data can be read.
     gaz_file = os.path.join(gaz_dir, "gazetteer.geojson")
     with open(gaz_file, "w") as gaz_out:
         json.dump(obj=gazetteer, fp=gaz_out)
 
+    write_gazetteer_detail(gazetteer, gaz_dir)
+
     alias_file = os.path.join(gaz_dir, "location_aliases.csv")
     with open(alias_file, "w") as alias_out:
         alias_out.write(location_aliases)
@@ -278,132 +1103,1438 @@ def server_update_gazetteer(payload: dict) -> None:
     current.cache.ram.clear("index")
     current.cache.ram("index", get_index, time_expire=None)
 
-    # Now if all is well, allow those updates to be committed.
-    db.commit()
+    # Remove the cached gazetteer tiles from the previous data. Tiles being rendered
+    # from the previous data by other requests are not cached, as the hash has changed.
+    shutil.rmtree(
+        os.path.join(current.request.folder, "cache", "gazetteer_tiles"),
+        ignore_errors=True,
+    )
 
     return
 
 
-# API search functions
+def update_location_resolution(dataset_id=None):
+    """Update the resolved dataset locations.
 
+    This function rebuilds the rows in the dataset_location_resolved table for a single
+    published dataset or, if no dataset id is provided, for all datasets. Each dataset
+    location is resolved to a gazetteer location using the location name, then aliases
+    for the dataset record and then general aliases, and is given the local geometry of
+    that gazetteer location or, if it is not resolved, the geometry from the dataset.
 
-def dataset_query_to_json(
-    qry,
-    most_recent=False,
-    ids=None,
-    fields=[
-        ("published_datasets", "zenodo_concept_id"),
-        ("published_datasets", "zenodo_record_id"),
-        ("published_datasets", "dataset_title"),
-    ],
-):
-    """
-    Shared function to take a Query including rows in db.published datasets
-    and return a standardised set of attributes and a count.
+    The footprints of the datasets, used by the bbox search, are then updated to the
+    convex hull of the resolved location geometries, and the coverage grid cells are
+    updated using update_dataset_coverage.
+
+    Args:
+        dataset_id: An optional published_datasets id.
     """
 
     db = current.db
 
-    if most_recent:
-        qry &= db.published_datasets.most_recent == True
+    if dataset_id is None:
+        db.dataset_location_resolved.truncate()
+        where, placeholders = "", None
+    else:
+        db(db.dataset_location_resolved.dataset_id == dataset_id).delete()
+        where, placeholders = "WHERE dataset_locations.dataset_id = %s", (dataset_id,)
+
+    # Booleans are stored by the DAL as T and F
+    db.executesql(
+        "INSERT INTO dataset_location_resolved "
+        "(dataset_id, location_id, name, location, in_gazetteer, wkt_local) "
+        "SELECT res.dataset_id, res.location_id, res.name, res.location, "
+        "CASE WHEN gazetteer.id IS NULL THEN 'F' ELSE 'T' END, "
+        "COALESCE(gazetteer.wkt_local, res.wkt_local) "
+        "FROM (SELECT dataset_locations.dataset_id, "
+        "dataset_locations.id AS location_id, dataset_locations.name, "
+        "dataset_locations.wkt_local, COALESCE("
+        "(SELECT gazetteer.location FROM gazetteer "
+        "WHERE gazetteer.location = dataset_locations.name), "
+        "(SELECT gazetteer_alias.location FROM gazetteer_alias "
+        "WHERE gazetteer_alias.alias = dataset_locations.name "
+        "AND gazetteer_alias.zenodo_record_id = published_datasets.zenodo_record_id "
+        "LIMIT 1), "
+        "(SELECT gazetteer_alias.location FROM gazetteer_alias "
+        "WHERE gazetteer_alias.alias = dataset_locations.name "
+        "AND gazetteer_alias.zenodo_record_id IS NULL LIMIT 1), "
+        "dataset_locations.name) AS location "
+        "FROM dataset_locations JOIN published_datasets "
+        f"ON published_datasets.id = dataset_locations.dataset_id {where}) AS res "
+        "LEFT JOIN gazetteer ON gazetteer.location = res.location;",
+        placeholders=placeholders,
+    )
 
-    if ids is not None:
-        qry &= db.published_datasets.zenodo_record_id.belongs(ids)
+    # Update the dataset footprints from the resolved location geometries, using the
+    # geographic extent for datasets without location geometries.
+    where = "" if dataset_id is None else "WHERE published_datasets.id = %s"
+    db.executesql(
+        "UPDATE published_datasets SET geographic_footprint_local = COALESCE("
+        "(SELECT ST_ConvexHull(ST_Collect(dataset_location_resolved.wkt_local)) "
+        "FROM dataset_location_resolved "
+        "WHERE dataset_location_resolved.dataset_id = published_datasets.id), "
+        f"published_datasets.geographic_extent_local) {where};",
+        placeholders=placeholders,
+    )
 
-    # Turn fields argument into fields references and select
-    fields = [db[t][f] for t, f in fields]
-    rows = db(qry).select(*fields, distinct=True)
+    update_dataset_coverage(dataset_id)
 
-    return {"count": len(rows), "entries": rows}
 
+def update_dataset_coverage(dataset_id=None):
+    """Update the coverage grid cells for datasets.
 
-def dataset_taxon_search(taxon_id=None, name=None, rank=None, auth=None):
+    This function rebuilds the rows in the dataset_coverage table for a single published
+    dataset or, if no dataset id is provided, for all datasets. The table records the
+    cells in each of the coverage grids and cell sizes that intersect the resolved
+    location geometries of each dataset.
 
-    """Search for datasets by taxon information
+    Args:
+        dataset_id: An optional published_datasets id.
+    """
 
-    Examples:
-        /api/search/taxa.json?name=Formicidae
-        /api/search/taxa.json?taxon_id=4342&auth=GBIF
-        /api/search/taxa.json?rank=Family
+    db = current.db
 
-    Args:
-        taxon_id (int): A taxon id code.
-        name (str): A scientific name
-        rank (str): A taxonomic rank. Note that GBIF only provides
-            kingdom, phylum, order, class, family, genus and species.
-        auth (str): The taxonomic database used to validate the taxon.
+    if dataset_id is None:
+        db.dataset_coverage.truncate()
+        where, dataset_ids = "", []
+    else:
+        db(db.dataset_coverage.dataset_id == dataset_id).delete()
+        where = "AND dataset_location_resolved.dataset_id = %s"
+        dataset_ids = [dataset_id]
+
+    for grid, (grid_function, _) in COVERAGE_GRIDS.items():
+        for cell_size in COVERAGE_CELL_SIZES:
+            db.executesql(
+                "INSERT INTO dataset_coverage "
+                "(dataset_id, grid, cell_size, cell_i, cell_j) "
+                "SELECT DISTINCT dataset_location_resolved.dataset_id, %s, %s, "
+                "cells.i, cells.j FROM dataset_location_resolved, "
+                f"{grid_function}(%s, dataset_location_resolved.wkt_local) AS cells "
+                "WHERE ST_Intersects(cells.geom, dataset_location_resolved.wkt_local) "
+                f"{where};",
+                placeholders=[grid, cell_size, cell_size] + dataset_ids,
+            )
+
+
+def get_coverage(grid="hex", cell_size=5000, year=None, most_recent=False):
+    """
+    Function to get the coverage of dataset locations on a grid as a GeoJSON string.
+    This returns a FeatureCollection of the grid cells intersecting dataset locations,
+    in WGS84 with coordinates rounded to 5 decimal places, giving the number of
+    datasets in each cell. If a year is provided, only datasets with a temporal extent
+    including that year are counted. The grid cells are precomputed, so the grid and
+    cell size must be one of the COVERAGE_GRIDS and COVERAGE_CELL_SIZES, and a
+    ValueError is raised otherwise.
     """
 
     db = current.db
-    qry = db.published_datasets.id == db.dataset_taxa.dataset_id
+    epsg = int(current.configuration.get("geo.local_epsg"))
 
-    if auth is not None:
-        qry &= db.dataset_taxa.taxon_auth == auth
+    if grid not in COVERAGE_GRIDS:
+        raise ValueError(f"Unknown coverage grid: {grid}")
 
-    if taxon_id is not None:
-        qry &= db.dataset_taxa.taxon_id == taxon_id
+    if cell_size not in COVERAGE_CELL_SIZES:
+        sizes = ", ".join(str(sz) for sz in COVERAGE_CELL_SIZES)
+        raise ValueError(f"Coverage cell size must be one of: {sizes}")
 
-    if name is not None:
-        qry &= db.dataset_taxa.taxon_name == name
+    where = ["dataset_coverage.grid = %s", "dataset_coverage.cell_size = %s"]
+    placeholders = [cell_size, grid, cell_size]
 
-    if rank is not None:
-        qry &= db.dataset_taxa.taxon_rank == rank.lower()
+    if year is not None:
+        where.append(
+            "EXTRACT(YEAR FROM published_datasets.temporal_extent_start) <= %s "
+            "AND EXTRACT(YEAR FROM published_datasets.temporal_extent_end) >= %s"
+        )
+        placeholders += [year, year]
 
-    return qry
+    if most_recent:
+        where.append("published_datasets.most_recent = 'T'")
+
+    # The cell geometries are created from the cell indices and converted to GeoJSON
+    # in the database, so that the cells are only assembled into features here.
+    _, cell_function = COVERAGE_GRIDS[grid]
+    rows = db.executesql(
+        "SELECT ST_AsGeoJSON(ST_Transform(ST_SetSRID("
+        f"{cell_function}(%s, dataset_coverage.cell_i, dataset_coverage.cell_j), "
+        f"{epsg}), 4326), 5), COUNT(DISTINCT dataset_coverage.dataset_id) "
+        "FROM dataset_coverage JOIN published_datasets "
+        "ON published_datasets.id = dataset_coverage.dataset_id "
+        f"WHERE {' AND '.join(where)} "
+        "GROUP BY dataset_coverage.cell_i, dataset_coverage.cell_j "
+        "ORDER BY dataset_coverage.cell_i, dataset_coverage.cell_j;",
+        placeholders=placeholders,
+    )
 
+    features = ",".join(
+        '{"type":"Feature","geometry":%s,"properties":{"n_datasets":%d}}' % row
+        for row in rows
+    )
 
-def dataset_author_search(name=None):
+    return (
+        '{"type":"FeatureCollection","grid":%s,"cell_size":%d,"year":%s,'
+        '"features":[%s]}' % (json.dumps(grid), cell_size, json.dumps(year), features)
+    )
 
-    """Search for datasets by author name
 
-    Examples:
-        /api/search/authors.json?name=Wilk
+def write_gazetteer_detail(gazetteer, gaz_dir):
+    """Write the simplified levels of detail of the gazetteer GeoJSON.
+
+    This function simplifies the location geometries in the gazetteer GeoJSON data for
+    each level of detail in GAZETTEER_DETAIL, snaps the coordinates to the precision
+    for that level and writes the resulting compact GeoJSON to a file for each level of
+    detail in the gazetteer directory. Small geometries that collapse at that precision
+    are replaced by a representative point, so that all locations are kept.
 
     Args:
-        name (str): An author name or part of a name
+        gazetteer: The gazetteer GeoJSON data
+        gaz_dir: The directory holding the gazetteer files
     """
 
-    db = current.db
-    qry = db.published_datasets.id == db.dataset_authors.dataset_id
+    for detail, (tolerance, decimals) in GAZETTEER_DETAIL.items():
+        grid_size = 10**-decimals
+        features = []
+        for ft in gazetteer["features"]:
+            if ft.get("geometry") is not None:
+                source = shape(ft["geometry"])
+                geom = source.simplify(tolerance, preserve_topology=True)
+                geom = shapely.set_precision(geom, grid_size)
+                if geom.is_empty:
+                    point = source.representative_point()
+                    geom = shapely.set_precision(point, grid_size)
+                ft = dict(ft, geometry=mapping(geom))
+
+            features.append(ft)
+
+        # Write to a temporary file and then move it into place, so that other requests
+        # never read a partly written file.
+        detail_file = os.path.join(gaz_dir, f"gazetteer_{detail}.geojson")
+        temp_file = f"{detail_file}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp_file, "w") as detail_out:
+            json.dump(
+                obj=dict(gazetteer, features=features),
+                fp=detail_out,
+                separators=(",", ":"),
+            )
+        os.replace(temp_file, detail_file)
 
-    if name is not None:
-        qry &= db.dataset_authors.name.contains(name.lower())
 
-    return qry
+def get_gazetteer_file(detail="full"):
+    """
+    Function to get the path to the gazetteer GeoJSON file for a level of detail, which
+    is either 'full' or one of GAZETTEER_DETAIL. The simplified files are created from
+    the full gazetteer if they are missing. A FileNotFoundError is raised if no
+    gazetteer data has been posted.
+    """
+
+    gaz_dir = os.path.join(current.request.folder, "static", "files", "gis")
+    gaz_file = os.path.join(gaz_dir, "gazetteer.geojson")
 
+    if detail == "full":
+        return gaz_file
 
-def dataset_locations_search(name=None):
+    detail_file = os.path.join(gaz_dir, f"gazetteer_{detail}.geojson")
 
-    """Search for datasets with data at a named location
+    if not os.path.exists(detail_file):
+        with open(gaz_file) as gaz_in:
+            write_gazetteer_detail(json.load(gaz_in), gaz_dir)
 
-    Examples:
-        /api/search/locations.json?name=A_1
+    return detail_file
 
-    Args:
-        name (str): A location name
+
+def export_gazetteer(export_type, locations=None):
+    """
+    Function to export the gazetteer locations as a GPX or GeoJSON string, using a
+    single query to get the locations, optionally restricted to a list of location
+    names. The GeoJSON export includes the GAZETTEER_FIELDS as properties and the
+    geometries are assembled into the features as the GeoJSON text returned by the
+    database. The GPX export gives the centroids of locations as waypoints, excluding
+    linear locations as their centroids may not fall on the line.
     """
 
     db = current.db
-    qry = db.published_datasets.id == db.dataset_locations.dataset_id
 
-    if name is not None:
-        qry &= db.dataset_locations.name.contains(name.lower())
+    if locations is None:
+        where, placeholders = "", None
+    else:
+        where, placeholders = "AND gazetteer.location = ANY(%s)", (list(locations),)
+
+    if export_type == "gpx":
+        rows = db.executesql(
+            "SELECT gazetteer.location, ST_X(ST_Centroid(gazetteer.wkt_wgs84)), "
+            "ST_Y(ST_Centroid(gazetteer.wkt_wgs84)) FROM gazetteer "
+            f"WHERE ST_Dimension(gazetteer.wkt_wgs84) <> 1 {where} "
+            "ORDER BY gazetteer.id;",
+            placeholders=placeholders,
+        )
 
-    return qry
+        gpx_data = gpx.GPX()
+        for location, longitude, latitude in rows:
+            gpx_data.waypoints.append(
+                gpx.GPXWaypoint(name=location, longitude=longitude, latitude=latitude)
+            )
 
+        return gpx_data.to_xml()
 
-def dataset_date_search(date=None, match_type="intersect"):
+    elif export_type == "geojson":
+        fields = ", ".join(f"gazetteer.{fld}" for fld in GAZETTEER_FIELDS)
+        rows = db.executesql(
+            f"SELECT gazetteer.id, {fields}, ST_AsGeoJSON(gazetteer.wkt_wgs84) "
+            f"FROM gazetteer WHERE TRUE {where} ORDER BY gazetteer.id;",
+            placeholders=placeholders,
+        )
 
-    """Search for datasets by temporal extent
+        features = ",".join(
+            '{"type":"Feature","id":%d,"properties":%s,"geometry":%s}'
+            % (
+                row[0],
+                json.dumps(dict(zip(GAZETTEER_FIELDS, row[1:-1]))),
+                row[-1] or "null",
+            )
+            for row in rows
+        )
 
-    Examples:
-        /api/search/dates.json?date=2014-06-12
-        /api/search/dates.json?date=2014-06-12,2015-06-12
-        /api/search/dates.json?date=2014-06-12,2015-06-12&match_type=contains
-        /api/search/dates.json?date=2014-06-12,2015-06-12&match_type=within
+        return (
+            '{"type":"FeatureCollection","crs":{"type":"name","properties":'
+            '{"name":"urn:ogc:def:crs:OGC:1.3:CRS84"}},"features":[%s]}' % features
+        )
 
-    Args:
-        date (str): A string containing one or two (comma separated) dates in ISO format (2019-06-12)
+    raise ValueError(f"Unknown gazetteer export type: {export_type}")
+
+
+def write_gazetteer_exports(gaz_dir):
+    """Write the exports of all gazetteer locations to files in the gazetteer directory.
+
+    Args:
+        gaz_dir: The directory holding the gazetteer files
+    """
+
+    for export_type, filename in GAZETTEER_EXPORTS.items():
+        # Write to a temporary file unique to this thread and then move it into place,
+        # so that other requests never read a partly written file.
+        export_file = os.path.join(gaz_dir, filename)
+        temp_file = f"{export_file}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp_file, "w") as export_out:
+            export_out.write(export_gazetteer(export_type))
+        os.replace(temp_file, export_file)
+
+
+def get_gazetteer_export_file(export_type):
+    """
+    Function to get the path to the file holding the export of all gazetteer locations
+    in a format from GAZETTEER_EXPORTS, creating the exports if they are missing.
+    """
+
+    gaz_dir = os.path.join(current.request.folder, "static", "files", "gis")
+    export_file = os.path.join(gaz_dir, GAZETTEER_EXPORTS[export_type])
+
+    if not os.path.exists(export_file):
+        write_gazetteer_exports(gaz_dir)
+
+    return export_file
+
+
+class Gazetteer:
+    """An in-memory copy of the gazetteer locations and location aliases.
+
+    The gazetteer is loaded from the GeoJSON and location alias files last posted to
+    the server, keeping only the local projected geometry of each location in display
+    order along with a spatial index of those geometries. This allows location names
+    and aliases to be resolved, location geometries to be searched and the locations at
+    a point to be found without querying the database. WGS84 geometries are not kept,
+    as they are only needed to project WGS84 query points, and features without a
+    geometry are skipped.
+
+    Attributes:
+        hash: The MD5 hashes of the gazetteer and location alias files.
+        locations: A dictionary of the local shapely geometries keyed by location name.
+        names: A list of the location names, in display order as used in the tree.
+        aliases: A dictionary of location names keyed by Zenodo record ID and alias,
+            where general aliases use a record ID of None.
+        tree: A shapely STRtree of the local location geometries.
+        to_local: A function to project WGS84 coordinates to the local projection.
+    """
+
+    def __init__(self, gazetteer, location_aliases, hash, epsg):
+        self.hash = hash
+        self.epsg = epsg
+        self.to_local = to_local = _local_transformer(epsg).transform
+
+        # Sort features into display order, keeping file order for equal values
+        features = sorted(
+            (ft for ft in gazetteer["features"] if ft.get("geometry") is not None),
+            key=lambda ft: ft["properties"].get("display_order") or 1,
+        )
+
+        self.locations = {
+            ft["properties"]["location"]: transform(to_local, shape(ft["geometry"]))
+            for ft in features
+        }
+
+        self.names = list(self.locations)
+        self.tree = STRtree(list(self.locations.values()))
+
+        self.aliases = {}
+        for row in DictReader(StringIO(location_aliases)):
+            record_id = row["zenodo_record_id"]
+            record_id = None if record_id == "NA" else int(record_id)
+            self.aliases[(record_id, row["alias"])] = row["location"]
+
+    def resolve(self, name, zenodo_record_id=None):
+        """
+        Get the gazetteer location for a location name or alias, using aliases for a
+        specific dataset record if provided, or None if the name is not recognised.
+        """
+
+        if name in self.locations:
+            return name
+
+        location = self.aliases.get((zenodo_record_id, name))
+        if location is None:
+            location = self.aliases.get((None, name))
+
+        return location
+
+    def query_geometry(self, names):
+        """
+        Get the combined local geometry of a list of location names or aliases as
+        hex EWKB for use in queries, raising a ValueError for unknown locations.
+        """
+
+        locations = [self.resolve(nm) for nm in names]
+
+        if None in locations:
+            raise ValueError("Unknown location")
+
+        geom = unary_union([self.locations[loc] for loc in locations])
+
+        return shapely_wkb.dumps(geom, hex=True, srid=self.epsg)
+
+    def locations_at(self, point, wgs84=False):
+        """
+        Get the names of the locations containing a point, in display order. The point
+        is a local projected shapely Point or, if wgs84 is True, a WGS84 longitude and
+        latitude Point.
+        """
+
+        if wgs84:
+            point = transform(self.to_local, point)
+
+        idx = self.tree.query(point, predicate="within")
+        return [self.names[i] for i in sorted(idx)]
+
+
+# The gazetteer for this process and the file status used to check for new versions
+_GAZETTEER = {"stat": None, "gazetteer": None}
+_GAZETTEER_LOCK = threading.Lock()
+
+
+def get_gazetteer():
+    """
+    Function to get the in-memory Gazetteer for this process. This checks the status
+    of the gazetteer and location alias files on each call, which is fast, and the
+    Gazetteer is reloaded if the file hashes have changed, so that each process picks
+    up new gazetteer data posted to any process. If the files have not been posted,
+    this returns None.
+    """
+
+    gis_dir = os.path.join(current.request.folder, "static", "files", "gis")
+    files = [
+        os.path.join(gis_dir, "gazetteer.geojson"),
+        os.path.join(gis_dir, "location_aliases.csv"),
+    ]
+
+    with _GAZETTEER_LOCK:
+        try:
+            stat = [(st.st_mtime_ns, st.st_size) for st in map(os.stat, files)]
+        except FileNotFoundError:
+            return None
+
+        if stat == _GAZETTEER["stat"]:
+            return _GAZETTEER["gazetteer"]
+
+        # Use the same hashes of the file contents as the index hashes
+        contents = []
+        for fname in files:
+            with open(fname) as f:
+                contents.append(f.read())
+
+        hash = tuple(hashlib.md5(ct.encode("utf-8")).hexdigest() for ct in contents)
+        gazetteer = _GAZETTEER["gazetteer"]
+
+        if gazetteer is None or gazetteer.hash != hash:
+            gazetteer = Gazetteer(
+                json.loads(contents[0]),
+                contents[1],
+                hash,
+                int(current.configuration.get("geo.local_epsg")),
+            )
+
+        _GAZETTEER.update(stat=stat, gazetteer=gazetteer)
+
+        return gazetteer
+
+
+def get_gazetteer_tile(z, x, y):
+    """
+    Function to get a Mapbox Vector Tile of the gazetteer locations, with the location
+    name and display order of each location in the 'gazetteer' layer. Tiles are rendered
+    by PostGIS and tiles containing locations up to GAZETTEER_TILE_CACHE_MAX_ZOOM are
+    then cached on disk, under the hash of the gazetteer file so that tiles from
+    previous versions of the gazetteer are never used. Tiles are only cached if the
+    hash has not changed while rendering the tile and the cache is cleared when the
+    gazetteer is updated. A ValueError is raised for invalid tile coordinates.
+    """
+
+    if not 0 <= z <= GAZETTEER_TILE_MAX_ZOOM:
+        raise ValueError(f"Tile zoom must be between 0 and {GAZETTEER_TILE_MAX_ZOOM}")
+
+    if not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise ValueError("Tile coordinates outside of zoom level")
+
+    # No tiles are cached until gazetteer data has been loaded
+    gazetteer = get_gazetteer()
+    cached = gazetteer is not None and z <= GAZETTEER_TILE_CACHE_MAX_ZOOM
+
+    if cached:
+        tile_file = os.path.join(
+            current.request.folder,
+            "cache",
+            "gazetteer_tiles",
+            gazetteer.hash[0],
+            str(z),
+            str(x),
+            f"{y}.mvt",
+        )
+
+        if os.path.exists(tile_file):
+            with open(tile_file, "rb") as tile_in:
+                return tile_in.read()
+
+    # Find the locations in the tile using the index on the WGS84 geometries and then
+    # clip them to the tile in Web Mercator, in display order.
+    tile = current.db.executesql(
+        "WITH bounds AS (SELECT ST_TileEnvelope(%s, %s, %s) AS geom), "
+        "locations AS (SELECT ST_AsMVTGeom(ST_Transform(gazetteer.wkt_wgs84, 3857), "
+        "bounds.geom) AS geom, gazetteer.location, gazetteer.display_order "
+        "FROM gazetteer, bounds "
+        "WHERE gazetteer.wkt_wgs84 && ST_Transform(bounds.geom, 4326) "
+        "ORDER BY gazetteer.display_order, gazetteer.id) "
+        "SELECT ST_AsMVT(locations.*, 'gazetteer') FROM locations "
+        "WHERE locations.geom IS NOT NULL;",
+        placeholders=(z, x, y),
+    )[0][0]
+    tile = b"" if tile is None else bytes(tile)
+
+    if cached and tile:
+        # Write to a temporary file and then move it into place, so that other requests
+        # never read a partly written tile, unless the gazetteer has been updated since
+        # the tile cache file was chosen.
+        os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+        temp_file = f"{tile_file}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp_file, "wb") as tile_out:
+            tile_out.write(tile)
+
+        current_gazetteer = get_gazetteer()
+        if current_gazetteer is not None and current_gazetteer.hash == gazetteer.hash:
+            os.replace(temp_file, tile_file)
+        else:
+            os.remove(temp_file)
+
+    return tile
+
+
+# The indexed geometries and dataset ids held by the SpatialEngine, which are replaced
+# as a whole when the engine is updated, so that searches always use matching trees and
+# dataset ids. The location names map gazetteer locations to frozensets of dataset ids.
+SpatialIndexes = namedtuple(
+    "SpatialIndexes",
+    [
+        "gazetteer_hash",
+        "last_id",
+        "extent_ids",
+        "extent_geoms",
+        "footprint_geoms",
+        "location_ids",
+        "location_geoms",
+        "location_names",
+        "extent_tree",
+        "footprint_tree",
+        "location_tree",
+    ],
+)
+
+
+class SpatialEngine:
+    """An in-memory spatial index of dataset geographic extents and locations.
+
+    This optional search engine holds the local projected geographic extents of
+    published datasets and the local geometries of dataset locations in shapely
+    STRtrees, so that spatial searches can find matching datasets without evaluating
+    spatial predicates for every row in the database. The searches return the matching
+    published_datasets ids, which are passed on to dataset_query_to_json.
+
+    The engine is loaded when first used in each process and is updated to include
+    datasets published since it was last updated, by any process, before each search.
+    Datasets are never removed, so the indexes only need to grow, but the engine is
+    reloaded when the gazetteer changes, as this changes how locations are resolved.
+
+    The trees and dataset ids are held together in a SpatialIndexes tuple. Updates
+    build a complete new tuple and replace the current one in a single assignment, so
+    searches running in other threads use a consistent copy of the indexes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.indexes = self._empty_indexes(None)
+
+    @staticmethod
+    def _empty_indexes(gazetteer_hash):
+        return SpatialIndexes(
+            gazetteer_hash=gazetteer_hash,
+            last_id=0,
+            extent_ids=(),
+            extent_geoms=(),
+            footprint_geoms=(),
+            location_ids=(),
+            location_geoms=(),
+            location_names={},
+            extent_tree=STRtree([]),
+            footprint_tree=STRtree([]),
+            location_tree=STRtree([]),
+        )
+
+    def refresh(self, gazetteer_hash=None):
+        """
+        Add any newly published datasets to the indexes, reloading all datasets if the
+        gazetteer hash has changed.
+        """
+
+        db = current.db
+
+        with self._lock:
+            indexes = self.indexes
+            if gazetteer_hash != indexes.gazetteer_hash:
+                indexes = self._empty_indexes(gazetteer_hash)
+
+            last_id = db.executesql("SELECT MAX(id) FROM published_datasets;")[0][0]
+            if last_id is None or last_id <= indexes.last_id:
+                self.indexes = indexes
+                return
+
+            extents = db.executesql(
+                "SELECT id, geographic_extent_local, COALESCE("
+                "geographic_footprint_local, geographic_extent_local) "
+                "FROM published_datasets "
+                "WHERE id > %s AND id <= %s AND geographic_extent_local IS NOT NULL;",
+                placeholders=(indexes.last_id, last_id),
+            )
+            locations = db.executesql(
+                "SELECT dataset_id, location, in_gazetteer, wkt_local "
+                "FROM dataset_location_resolved "
+                "WHERE dataset_id > %s AND dataset_id <= %s;",
+                placeholders=(indexes.last_id, last_id),
+            )
+
+            # Copy the current contents, so that searches using the current indexes
+            # are not affected by adding the new datasets.
+            extent_ids = list(indexes.extent_ids)
+            extent_geoms = list(indexes.extent_geoms)
+            footprint_geoms = list(indexes.footprint_geoms)
+            location_ids = list(indexes.location_ids)
+            location_geoms = list(indexes.location_geoms)
+            location_names = dict(indexes.location_names)
+
+            # Resolved locations are found using the gazetteer tree, so only the
+            # geometries of unresolved new locations are held in the location tree.
+            for dataset_id, location, in_gazetteer, geom in locations:
+                if in_gazetteer == "T":
+                    location_names[location] = location_names.get(
+                        location, frozenset()
+                    ) | {dataset_id}
+                elif geom is not None:
+                    location_ids.append(dataset_id)
+                    location_geoms.append(shapely_wkb.loads(geom, hex=True))
+
+            for dataset_id, geom, footprint in extents:
+                extent_ids.append(dataset_id)
+                extent_geoms.append(shapely_wkb.loads(geom, hex=True))
+                footprint_geoms.append(shapely_wkb.loads(footprint, hex=True))
+
+            # STRtrees cannot be extended, so new trees are built and then the new
+            # indexes replace the indexes used by searches
+            self.indexes = SpatialIndexes(
+                gazetteer_hash=gazetteer_hash,
+                last_id=last_id,
+                extent_ids=tuple(extent_ids),
+                extent_geoms=tuple(extent_geoms),
+                footprint_geoms=tuple(footprint_geoms),
+                location_ids=tuple(location_ids),
+                location_geoms=tuple(location_geoms),
+                location_names=location_names,
+                extent_tree=STRtree(extent_geoms),
+                footprint_tree=STRtree(footprint_geoms),
+                location_tree=STRtree(location_geoms),
+            )
+
+    @staticmethod
+    def _within_distance(tree, geom, distance):
+        """Get the indices of geometries in a tree within a distance of a geometry."""
+
+        if not distance:
+            return tree.query(geom, predicate="intersects")
+
+        # Use the tree to find candidates near the geometry bounds and then check the
+        # actual distances to those candidates.
+        min_x, min_y, max_x, max_y = geom.bounds
+        idx = tree.query(
+            box(min_x - distance, min_y - distance, max_x + distance, max_y + distance)
+        )
+
+        return idx[shapely.distance(geom, tree.geometries.take(idx)) <= distance]
+
+    def location_search(self, geom, distance, gazetteer):
+        """
+        Get the ids of datasets with locations within a distance of a local geometry.
+        Dataset locations match using the geometry of the gazetteer location they
+        resolve to or the geometry provided for a new location in the dataset.
+        """
+
+        indexes = self.indexes
+
+        idx = self._within_distance(indexes.location_tree, geom, distance)
+        ids = {indexes.location_ids[i] for i in idx}
+
+        if gazetteer is not None:
+            for i in self._within_distance(gazetteer.tree, geom, distance):
+                ids.update(indexes.location_names.get(gazetteer.names[i], ()))
+
+        return ids
+
+    def extent_search(self, geom, match_type, distance, geometry="extent"):
+        """
+        Get the ids of datasets with a geographic extent, or footprint, that matches a
+        local geometry using one of the bbox search match types.
+        """
+
+        indexes = self.indexes
+        if geometry == "footprint":
+            tree = indexes.footprint_tree
+        else:
+            tree = indexes.extent_tree
+
+        # The tree predicates test the query geometry against the extents, so a query
+        # geometry within an extent is contained by that extent.
+        if match_type == "intersect":
+            idx = tree.query(geom, predicate="intersects")
+        elif match_type == "contain":
+            idx = tree.query(geom, predicate="within")
+        elif match_type == "within":
+            idx = tree.query(geom, predicate="contains")
+        else:
+            idx = self._within_distance(tree, geom, distance)
+
+        return {indexes.extent_ids[i] for i in idx}
+
+
+SPATIAL_ENGINE = SpatialEngine()
+
+
+def get_spatial_engine():
+    """
+    Function to get the in-memory SpatialEngine, updated to include recently published
+    datasets, or None if the engine is not enabled in the geo.spatial_engine setting.
+    """
+
+    if current.configuration.get("geo.spatial_engine") != "memory":
+        return None
+
+    gazetteer = get_gazetteer()
+    SPATIAL_ENGINE.refresh(None if gazetteer is None else gazetteer.hash)
+    return SPATIAL_ENGINE
+
+
+# API search functions
+
+
+# Limits the number of streaming connections open in this process
+_STREAM_CONNECTIONS = threading.BoundedSemaphore(STREAM_MAX_CONNECTIONS)
+
+
+def iter_select(dbset, *fields, count_sql=None, **attributes):
+    """
+    Shared function to run a select on a set of rows using a dedicated database
+    connection and a server-side cursor, returning a generator of flat dictionaries
+    for each row. Rows are fetched from the database in chunks, and the connection is
+    independent of the request connection, which is returned to the connection pool
+    before a streamed response is sent. The connection is closed when the generator is
+    exhausted, closed or discarded, including generators that are never iterated, and
+    no more than STREAM_MAX_CONNECTIONS are open at once in each process. If no
+    connection becomes available within STREAM_CONNECTION_TIMEOUT seconds, this raises
+    an HTTP 503 error rather than holding the request indefinitely.
+
+    The connection uses a single read only, repeatable read transaction, so if SQL for
+    a count is provided, the count is read from the same snapshot as the rows. This
+    returns the count, or None if no count SQL is provided, and the generator of rows.
+    """
+
+    db = current.db
+    sql = dbset._select(*fields, **attributes)
+
+    # PyDAL stores booleans as characters, so these need converting from the raw values
+    is_bool = [fld.type == "boolean" for fld in fields]
+
+    # Get the trigram similarity threshold, which may have been set for this
+    # transaction by a fuzzy search, so that it can be applied to the new connection.
+    threshold = db.executesql(
+        "SELECT current_setting('pg_trgm.similarity_threshold', true);"
+    )[0][0]
+
+    if not _STREAM_CONNECTIONS.acquire(timeout=STREAM_CONNECTION_TIMEOUT):
+        raise HTTP(
+            503,
+            "Too many streamed responses, please try again later",
+            **{"Retry-After": str(STREAM_CONNECTION_TIMEOUT)},
+        )
+
+    closed = []
+
+    def _close():
+        if not closed:
+            closed.append(True)
+            try:
+                connection.close()
+            finally:
+                _STREAM_CONNECTIONS.release()
+
+    try:
+        connection = db._adapter.connector()
+    except Exception:
+        _STREAM_CONNECTIONS.release()
+        raise
+
+    count = None
+    try:
+        connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+
+        if threshold:
+            connection.cursor().execute(
+                "SELECT set_config('pg_trgm.similarity_threshold', %s, false);",
+                (threshold,),
+            )
+
+        if count_sql is not None:
+            count_cursor = connection.cursor()
+            count_cursor.execute(count_sql)
+            count = count_cursor.fetchone()[0]
+
+        cursor = connection.cursor(name="safedata_server_stream")
+        cursor.itersize = STREAM_CHUNK_SIZE
+        cursor.execute(sql)
+    except Exception:
+        _close()
+        raise
+
+    def _rows():
+        try:
+            names = None
+            for row in cursor:
+                if names is None:
+                    names = [col[0] for col in cursor.description]
+
+                yield _row_dict(names, row, is_bool)
+        finally:
+            _close()
+
+    # Generators that are never started do not run their finally clause, so also
+    # close the connection when the generator is discarded
+    rows = _rows()
+    weakref.finalize(rows, _close)
+
+    return count, rows
+
+
+def _row_dict(names, row, is_bool):
+    """
+    Convert a row of raw values from the database into a dictionary, converting the
+    characters used by PyDAL to store booleans.
+    """
+
+    return {
+        nm: (vl in (True, "T") if bl and vl is not None else vl)
+        for nm, vl, bl in zip(names, row, is_bool)
+    }
+
+
+def stream_json(entries, head="", tail="", encoded=False):
+    """
+    Generator to write an iterable of entries as a JSON array, optionally between a
+    head and tail string, yielding encoded chunks of STREAM_CHUNK_SIZE entries. The
+    tail can also be a function, which is called after the entries have been written.
+    If encoded is True, the entries are already JSON strings and are written as is.
+    """
+
+    chunk = [head, "["]
+
+    for idx, entry in enumerate(entries):
+        if idx:
+            chunk.append(",")
+        chunk.append(entry if encoded else web2py_json(entry))
+
+        if len(chunk) >= 2 * STREAM_CHUNK_SIZE:
+            yield "".join(chunk).encode("utf-8")
+            chunk = []
+
+    chunk.append("]")
+    chunk.append(tail() if callable(tail) else tail)
+    yield "".join(chunk).encode("utf-8")
+
+
+def _stream_entries(rows, count=None, limit=None, make_cursor=None, extra={}):
+    """
+    Shared function to stream rows from iter_select as JSON. If a count is provided,
+    the rows are written as the entries in an object with that count and any extra
+    values, otherwise as a JSON array. If make_cursor is provided, the object also
+    includes the cursor for the next page, created from the last entry when there are
+    more than limit rows.
+    """
+
+    page = {"next_cursor": None}
+
+    def _page_rows():
+        last = None
+        for idx, entry in enumerate(rows):
+            if idx == limit:
+                page["next_cursor"] = make_cursor(last)
+                rows.close()
+                break
+            last = entry
+            yield entry
+
+    if count is None:
+        return stream_json(_page_rows())
+
+    def _tail():
+        if make_cursor is None:
+            return "}"
+        return f', "next_cursor": {web2py_json(page["next_cursor"])}}}'
+
+    head = "".join(
+        [f'{{"count": {count}, ']
+        + [f"{web2py_json(ky)}: {web2py_json(vl)}, " for ky, vl in extra.items()]
+        + ['"entries": ']
+    )
+
+    return stream_json(_page_rows(), head=head, tail=_tail)
+
+
+def encode_cursor(values):
+    """
+    Encode the sort key values of the last entry in a page of results as an opaque
+    cursor string, used to request the following page.
+    """
+
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def _cursor_value_type(field_type):
+    """
+    Get the Python types of valid cursor values for a sort key with a PyDAL field type.
+    """
+
+    if field_type in ("id", "integer", "bigint") or field_type.startswith("reference"):
+        return int
+
+    if field_type == "double" or field_type.startswith("decimal"):
+        return (int, float)
+
+    return str
+
+
+def decode_cursor(cursor, keys):
+    """
+    Decode a cursor string back into a list of sort key values, raising a ValueError
+    if the cursor is malformed or does not provide a value of the expected type for
+    each of the sort key fields or expressions.
+    """
+
+    if not isinstance(cursor, str):
+        raise ValueError("Invalid cursor")
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+    if not (
+        isinstance(values, list)
+        and len(values) == len(keys)
+        and all(
+            isinstance(vl, _cursor_value_type(key.type)) and not isinstance(vl, bool)
+            for key, vl in zip(keys, values)
+        )
+    ):
+        raise ValueError("Invalid cursor")
+
+    return values
+
+
+def _keyset_query(keys, values):
+    """
+    Build a query matching rows that sort after the provided values of a list of
+    ascending sort keys, for use in keyset pagination.
+    """
+
+    qry = keys[-1] > values[-1]
+
+    for key, value in zip(keys[-2::-1], values[-2::-1]):
+        qry = (key > value) | ((key == value) & qry)
+
+    return qry
+
+
+def dataset_query_to_json(
+    qry,
+    most_recent=False,
+    ids=None,
+    fields=[
+        ("published_datasets", "zenodo_concept_id"),
+        ("published_datasets", "zenodo_record_id"),
+        ("published_datasets", "dataset_title"),
+    ],
+    keys=[("published_datasets", "zenodo_record_id")],
+    limit=None,
+    cursor=None,
+    stream=False,
+    facets=None,
+):
+    """
+    Shared function to take a Query including rows in db.published datasets
+    and return a standardised set of attributes and a count. If the query is a
+    RankedQuery, the entries are ordered by decreasing rank, or increasing rank for
+    ascending ranks, and include the best rank value for each dataset using the rank
+    name, such as 'similarity'.
+
+    The entries are sorted using the key fields, which must be included in the fields
+    and must uniquely identify each entry. If a limit or cursor is provided, this
+    returns a page of at most limit entries, starting after any entry identified by the
+    cursor, along with the cursor for the next page. The count is always the total
+    number of entries matching the query.
+
+    If stream is True, this returns a generator that streams the same JSON content
+    directly from the database, rather than a dictionary.
+
+    If a list of facet names is provided, the response also includes the counts of
+    matching datasets for the values of each facet, from get_facets.
+    """
+
+    db = current.db
+
+    if isinstance(qry, RankedQuery):
+        qry, rank, rank_name, ascending = qry
+    else:
+        rank = None
+
+    if most_recent:
+        qry &= db.published_datasets.most_recent == True
+
+    if ids is not None:
+        qry &= _match_any(db.published_datasets.zenodo_record_id, ids)
+
+    # Turn fields and keys arguments into fields references
+    fields = [db[t][f] for t, f in fields]
+    keys = [db[t][f] for t, f in keys]
+
+    # Count the total entries in a separate query on the narrower set of key fields
+    paged = limit is not None or cursor is not None
+
+    # Streamed responses read the count from the same snapshot as the entries
+    count_sql = db(qry)._select(*keys, distinct=True).rstrip(";")
+    count_sql = f"SELECT COUNT(*) FROM ({count_sql}) AS entries;"
+
+    if paged and not stream:
+        count = PREPARED_STATEMENTS.executesql(count_sql)[0][0]
+
+    extra = {} if facets is None else {"facets": get_facets(qry, facets)}
+
+    limitby = None if limit is None else (0, limit + 1)
+
+    if rank is None:
+        # Select distinct entries, starting after the cursor key values
+        if cursor is not None:
+            qry &= _keyset_query(keys, decode_cursor(cursor, keys))
+
+        select_fields = fields
+        select_args = dict(distinct=True, orderby=keys, limitby=limitby)
+    else:
+        # Group on the fields to get the best rank for each dataset, ordering by
+        # the rank and then the keys, so the cursor also includes the rank.
+        score = rank.min() if ascending else rank.max()
+        orderby = [score if ascending else ~score] + keys
+        having = None
+
+        if cursor is not None:
+            values = decode_cursor(cursor, [score] + keys)
+            after = (score > values[0]) if ascending else (score < values[0])
+            having = after | ((score == values[0]) & _keyset_query(keys, values[1:]))
+
+        select_fields = fields + [score.with_alias(rank_name)]
+        select_args = dict(
+            groupby=fields, having=having, orderby=orderby, limitby=limitby
+        )
+
+    def _make_cursor(entry):
+        values = [entry[key.name] for key in keys]
+        if rank is not None:
+            values.insert(0, entry[rank_name])
+        return encode_cursor(values)
+
+    if stream:
+        count, rows = iter_select(
+            db(qry), *select_fields, count_sql=count_sql, **select_args
+        )
+        return _stream_entries(
+            rows,
+            count=count,
+            limit=limit,
+            make_cursor=_make_cursor if paged else None,
+            extra=extra,
+        )
+
+    # Run the search as a prepared statement, providing a flat json format for each
+    # entry directly from the database rows
+    rows = PREPARED_STATEMENTS.executesql(
+        db(qry)._select(*select_fields, **select_args)
+    )
+    names = [fld.name for fld in fields] + ([] if rank is None else [rank_name])
+    is_bool = [fld.type == "boolean" for fld in select_fields]
+    entries = [_row_dict(names, row, is_bool) for row in rows]
+
+    if not paged:
+        return dict(count=len(entries), **extra, entries=entries)
+
+    # Trim the extra entry used to detect a following page and set the next cursor
+    next_cursor = None
+    if limit is not None and len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = _make_cursor(entries[-1])
+
+    return dict(count=count, **extra, entries=entries, next_cursor=next_cursor)
+
+
+def get_facets(qry, facets):
+    """
+    Shared function to count the datasets matching a Query for the values of a list of
+    facets from SEARCH_FACETS. All of the facets are counted in a single statement,
+    grouping the facet values for the matching dataset ids, and the FACET_SIZE values
+    with the most datasets are returned for each facet, as a list of values and counts.
+    """
+
+    db = current.db
+    matches = db(qry)._select(db.published_datasets.id, distinct=True).rstrip(";")
+
+    counts = []
+    for facet in facets:
+        value, tables, dataset_id = SEARCH_FACETS[facet]
+        counts.append(
+            f"(SELECT CAST('{facet}' AS TEXT) AS facet, "
+            f"CAST({value} AS TEXT) AS value, "
+            f"COUNT(DISTINCT {dataset_id}) AS n_datasets FROM {tables} "
+            f"WHERE {dataset_id} IN (SELECT id FROM matches) AND {value} IS NOT NULL "
+            f"GROUP BY value ORDER BY n_datasets DESC, value LIMIT {FACET_SIZE})"
+        )
+
+    rows = PREPARED_STATEMENTS.executesql(
+        f"WITH matches AS ({matches}) {' UNION ALL '.join(counts)};"
+    )
+
+    val = OrderedDict((facet, []) for facet in facets)
+    for facet, value, n_datasets in rows:
+        if facet == "year":
+            value = int(float(value))
+        val[facet].append({"value": value, "count": n_datasets})
+
+    return val
+
+
+def _match_any(field, values):
+    """
+    Shared function to match a field against a list of values. The values are passed
+    to the database as a single array literal, so that the SQL statement is the same
+    for any number of values and can use the same prepared statement.
+    """
+
+    db = current.db
+    expand = db._adapter.expand
+
+    array = "{%s}" % ",".join(
+        '"%s"' % str(vl).replace("\\", "\\\\").replace('"', '\\"') for vl in values
+    )
+
+    def _any(first, second, query_env={}):
+        return "(%s = ANY(%s))" % (
+            expand(first, query_env=query_env),
+            expand(second, "string", query_env=query_env),
+        )
+
+    return Query(db, _any, field, array)
+
+
+def dataset_taxon_search(
+    taxon_id: typing.List[int] = None,
+    name: typing.List[str] = None,
+    rank: typing.List[str] = None,
+    auth: typing.List[str] = None,
+    include_descendants: bool = False,
+):
+
+    """Search for datasets by taxon information
+
+    Each variable can be provided more than once, to find datasets that match any of
+    the provided values. If include_descendants is set, the search also finds datasets
+    that record any taxa below the matching taxa in the taxonomic hierarchy, such as
+    datasets recording ant species when searching for Formicidae.
+
+    Examples:
+        /api/search/taxa.json?name=Formicidae
+        /api/search/taxa.json?name=Formicidae&name=Isoptera
+        /api/search/taxa.json?taxon_id=4342&auth=GBIF
+        /api/search/taxa.json?rank=Family
+        /api/search/taxa.json?name=Formicidae&include_descendants
+
+    Args:
+        taxon_id (int): One or more taxon id codes.
+        name (str): One or more scientific names
+        rank (str): One or more taxonomic ranks. Note that GBIF only provides
+            kingdom, phylum, order, class, family, genus and species.
+        auth (str): The taxonomic databases used to validate the taxon.
+        include_descendants (bool): Also match datasets recording descendant taxa.
+    """
+
+    db = current.db
+    qry = (db.published_datasets.id == db.dataset_taxon_links.dataset_id) & (
+        db.dataset_taxon_links.taxon == db.taxa.id
+    )
+    taxa = db.taxa.id > 0
+
+    if auth is not None:
+        taxa &= _match_any(db.taxa.taxon_auth, auth)
+
+    if taxon_id is not None:
+        taxa &= _match_any(db.taxa.taxon_id, taxon_id)
+
+    if name is not None:
+        taxa &= _match_any(db.taxa.taxon_name, name)
+
+    if rank is not None:
+        taxa &= _match_any(db.taxa.taxon_rank, [rk.lower() for rk in rank])
+
+    if not include_descendants:
+        return qry & taxa
+
+    # Match the dataset taxa to the taxon closure and then match the search to the
+    # ancestors in the closure, which include the dataset taxa themselves
+    closure = db.taxon_closure
+    qry &= (closure.taxon_auth == db.taxa.taxon_auth) & (
+        closure.descendant_id == db.taxa.taxon_id
+    )
+
+    if auth is not None:
+        qry &= _match_any(closure.taxon_auth, auth)
+
+    # Taxon ids are matched directly to the ancestor ids, so higher taxa that are not
+    # themselves recorded in datasets can also be found
+    if taxon_id is not None:
+        qry &= closure.ancestor_id.belongs(taxon_id)
+
+    # Names and ranks are only held in the taxa table, so the ancestors are matched to
+    # the taxa with those names and ranks in the same authority
+    if name is not None or rank is not None:
+        ancestor = db.taxa.with_alias("ancestor_taxa")
+        qry &= (ancestor.taxon_auth == closure.taxon_auth) & (
+            ancestor.taxon_id == closure.ancestor_id
+        )
+
+        if name is not None:
+            qry &= _match_any(ancestor.taxon_name, name)
+
+        if rank is not None:
+            qry &= _match_any(ancestor.taxon_rank, [rk.lower() for rk in rank])
+
+    return qry
+
+
+def _trigram_search(field, names, similarity):
+    """
+    Shared function to match a list of names against a text field. By default, this is
+    a case insensitive substring match but if a similarity threshold is provided, names
+    with at least that similarity to the field are matched and the best similarity
+    score across the names is returned to rank the results. Both forms can use trigram
+    GIN indexes on the field.
+    """
+
+    if similarity is None:
+        return field.contains(names, case_sensitive=False)
+
+    if not 0 < similarity <= 1:
+        return {"error": 400, "message": "Similarity must be between 0 and 1"}
+
+    db = current.db
+    expand = db._adapter.expand
+
+    # The pg_trgm % operator uses the index to find candidate matches, using the
+    # similarity_threshold setting for the current transaction. Searches can combine
+    # fuzzy matches with different thresholds, so the setting is lowered to the
+    # smallest threshold used in the transaction, which is tracked using a custom
+    # setting, and each match then also checks the similarity against its own threshold.
+    db.executesql(
+        "WITH threshold AS (SELECT CAST(LEAST(%s, COALESCE(CAST(NULLIF("
+        "current_setting('safedata.similarity_threshold', true), '') AS FLOAT), 1)) "
+        "AS TEXT) AS value) "
+        "SELECT set_config('safedata.similarity_threshold', value, true), "
+        "set_config('pg_trgm.similarity_threshold', value, true) FROM threshold;",
+        placeholders=(similarity,),
+    )
+
+    def _match(first, second, query_env={}):
+        field_sql = expand(first, query_env=query_env)
+        name_sql = expand(second, "string", query_env=query_env)
+        return "(%s %% %s AND similarity(%s, %s) >= %s)" % (
+            field_sql,
+            name_sql,
+            field_sql,
+            name_sql,
+            expand(similarity, "double", query_env=query_env),
+        )
+
+    def _similarity(first, second, query_env={}):
+        return "CAST(GREATEST(%s) AS DOUBLE PRECISION)" % ", ".join(
+            "similarity(%s, %s)"
+            % (
+                expand(first, query_env=query_env),
+                expand(nm, "string", query_env=query_env),
+            )
+            for nm in second
+        )
+
+    match = None
+    for nm in names:
+        name_match = Query(db, _match, field, nm)
+        match = name_match if match is None else match | name_match
+
+    return RankedQuery(match, Expression(db, _similarity, field, names, "double"))
+
+
+def dataset_author_search(name: typing.List[str] = None, similarity: float = None):
+
+    """Search for datasets by author name
+
+    Names are matched case-insensitively against any part of author names. If a
+    similarity threshold is provided, names are instead matched using trigram
+    similarity, which tolerates typos, and results are ordered by decreasing
+    similarity. If more than one name is provided, datasets matching any of the names
+    are returned.
+
+    Examples:
+        /api/search/authors.json?name=Wilk
+        /api/search/authors.json?name=Wilk&name=Ewers
+        /api/search/authors.json?name=Wilkinsen&similarity=0.3
+
+    Args:
+        name (str): One or more author names or parts of names
+        similarity (float): An optional similarity threshold between 0 and 1.
+    """
+
+    db = current.db
+    qry = db.published_datasets.id == db.dataset_authors.dataset_id
+
+    if name is not None:
+        name_qry = _trigram_search(db.dataset_authors.name, name, similarity)
+
+        if isinstance(name_qry, dict):
+            return name_qry
+        elif isinstance(name_qry, RankedQuery):
+            return RankedQuery(qry & name_qry.query, name_qry.rank)
+
+        qry &= name_qry
+
+    return qry
+
+
+def dataset_locations_search(
+    name: typing.List[str] = None, similarity: float = None
+):
+
+    """Search for datasets with data at a named location
+
+    Names are matched case-insensitively against any part of location names. If a
+    similarity threshold is provided, names are instead matched using trigram
+    similarity, which tolerates typos, and results are ordered by decreasing
+    similarity. If more than one name is provided, datasets matching any of the names
+    are returned. Dataset locations are matched using both the name recorded in the
+    dataset and the gazetteer location that name resolves to, so datasets that use
+    location aliases are found using either the alias or the gazetteer name, and names
+    that are general location aliases are also searched for using the gazetteer name.
+
+    Examples:
+        /api/search/locations.json?name=A_1
+        /api/search/locations.json?name=A_1&name=B_1
+        /api/search/locations.json?name=BL_A&similarity=0.5
+
+    Args:
+        name (str): One or more location names
+        similarity (float): An optional similarity threshold between 0 and 1.
+    """
+
+    db = current.db
+    qry = db.published_datasets.id == db.dataset_location_resolved.dataset_id
+
+    if name is not None:
+        # Add the gazetteer locations for any general aliases in the names
+        gazetteer = get_gazetteer()
+        if gazetteer is not None:
+            resolved = (gazetteer.resolve(nm) for nm in name)
+            name = list(OrderedDict.fromkeys([*name, *filter(None, resolved)]))
+
+        name_qry, location_qry = (
+            _trigram_search(fld, name, similarity)
+            for fld in (
+                db.dataset_location_resolved.name,
+                db.dataset_location_resolved.location,
+            )
+        )
+
+        if isinstance(name_qry, dict):
+            return name_qry
+        elif isinstance(name_qry, RankedQuery):
+            # Rank on the better similarity of the dataset and gazetteer names
+            def _greatest(first, second, query_env={}):
+                return "GREATEST(%s, %s)" % (
+                    db._adapter.expand(first, query_env=query_env),
+                    db._adapter.expand(second, query_env=query_env),
+                )
+
+            return RankedQuery(
+                qry & (name_qry.query | location_qry.query),
+                Expression(db, _greatest, name_qry.rank, location_qry.rank, "double"),
+            )
+
+        qry &= name_qry | location_qry
+
+    return qry
+
+
+def dataset_date_search(date: str = None, match_type: str = "intersect"):
+
+    """Search for datasets by temporal extent
+
+    Examples:
+        /api/search/dates.json?date=2014-06-12
+        /api/search/dates.json?date=2014-06-12,2015-06-12
+        /api/search/dates.json?date=2014-06-12,2015-06-12&match_type=contains
+        /api/search/dates.json?date=2014-06-12,2015-06-12&match_type=within
+
+    Args:
+        date (str): A string containing one or two (comma separated) dates in ISO format (2019-06-12)
         match_type (str): One of 'intersect', 'contain' and 'within' to match the provided dates to
             the temporal extents of datasets. The 'contain' option returns datasets that span a date
             range and 'within' returns datasets that fall within that date range.
@@ -455,18 +2586,25 @@ def dataset_date_search(date=None, match_type="intersect"):
     return qry
 
 
-def dataset_field_search(text=None, ftype=None):
+def dataset_field_search(
+    text: typing.List[str] = None, ftype: typing.List[str] = None
+):
 
     """Search for datasets by data field information
 
+    Each variable can be provided more than once, to find datasets that match any of
+    the provided values.
+
     Examples:
         /api/search/fields.json?text=temperature
+        /api/search/fields.json?text=temperature&text=humidity
         /api/search/fields.json?ftype=numeric
         /api/search/fields.json?text=temperature&ftype=numeric
 
     Args:
-        text (str): A string to look for within the field name and description.
-        ftype (str): A field type to match.
+        text (str): One or more strings to look for within the field name and
+            description.
+        ftype (str): One or more field types to match.
     """
 
     db = current.db
@@ -478,20 +2616,28 @@ def dataset_field_search(text=None, ftype=None):
         )
 
     if ftype is not None:
-        qry &= db.dataset_fields.field_type.ilike(ftype)
+        ftype_qry = db.dataset_fields.field_type.ilike(ftype[0])
+        for ft in ftype[1:]:
+            ftype_qry |= db.dataset_fields.field_type.ilike(ft)
+
+        qry &= ftype_qry
 
     return qry
 
 
-def dataset_text_search(text=None):
+def dataset_text_search(text: typing.List[str] = None):
 
     """Search for datasets by free text search
 
+    The text can be provided more than once, to find datasets that match any of the
+    provided strings.
+
     Examples:
         /api/search/text.json?text=humus
+        /api/search/text.json?text=humus&text=litter
 
     Args:
-        text (str): A string to look within dataset, worksheet and field
+        text (str): One or more strings to look within dataset, worksheet and field
         descriptions and titles and in dataset keywords.
     """
 
@@ -515,13 +2661,59 @@ def dataset_text_search(text=None):
     return qry
 
 
+@lru_cache(maxsize=None)
+def _local_transformer(epsg):
+    """Get a transformer from WGS84 longitude and latitude to a projected EPSG code."""
+
+    return Transformer.from_crs("EPSG:4326", f"EPSG:{epsg}", always_xy=True)
+
+
+@lru_cache(maxsize=QUERY_GEOMETRY_CACHE_SIZE)
+def _parse_wkt(wkt, epsg):
+    """
+    Shared function to parse and validate a WKT query geometry in WGS84 longitude and
+    latitude and project it to an EPSG code, returning hex EWKB for use in queries. The
+    most recently used query geometries are cached and a ValueError is raised for
+    invalid geometries.
+    """
+
+    # i) Does the WKT parse correctly to a geometry
+    try:
+        geom = shapely_wkt.loads(wkt)
+    except (ShapelyError, ValueError):
+        raise ValueError("Could not parse WKT geometry")
+
+    if geom.is_empty:
+        raise ValueError("Could not parse WKT geometry")
+
+    return _project_geometry(geom, epsg, "WKT geometry")
+
+
+def _project_geometry(geom, epsg, label):
+    """
+    Shared function to validate a shapely geometry in WGS84 longitude and latitude and
+    project it to an EPSG code, returning hex EWKB for use in queries. A ValueError
+    using the label to describe the geometry is raised for invalid coordinates.
+    """
+
+    # ii) Do the coordinates seem like lat long?
+    min_x, min_y, max_x, max_y = geom.bounds
+    if not (min_x >= -180 and max_x <= 180 and min_y >= -90 and max_y <= 90):
+        raise ValueError(f"{label} coordinates not as lat/long")
+
+    # iii) Convert to local projected
+    geom = transform(_local_transformer(epsg).transform, geom)
+
+    return shapely_wkb.dumps(geom, hex=True, srid=epsg)
+
+
 def dataset_parse_spatial(wkt=None, location=None):
 
     """
-    Shared function to parse query geometry options - either a location or a WKT - and get
-    # the query geometry as a UTM 50N geometry.
+    Shared function to parse query geometry options - either a list of locations or a
+    WKT - and get the query geometry as a UTM 50N geometry. The geometries of a list of
+    locations are combined into a single query geometry.
     """
-    db = current.db
 
     if (location is not None) and (wkt is not None):
         return {
@@ -534,46 +2726,28 @@ def dataset_parse_spatial(wkt=None, location=None):
             "message": "Provide either a location name or a WKT geometry",
         }
     elif location is not None:
-        gazetteer_location = gazetteer_location = (
-            db(db.gazetteer.location == location)
-            .select(db.gazetteer.wkt_local.st_aswkb().with_alias("wkb"))
-            .first()
-        )
-        if gazetteer_location is not None:
-            query_geom = gazetteer_location.wkb
-        else:
-            return {"error": 400, "message": "Unknown location"}
+        gazetteer = get_gazetteer()
+        if gazetteer is None:
+            return {"error": 400, "message": "Gazetteer data not loaded"}
+
+        try:
+            query_geom = gazetteer.query_geometry(location)
+        except ValueError as err:
+            return {"error": 400, "message": str(err)}
     elif wkt is not None:
-        # Validate the geometry - there isn't currently a validator, so use the DB (?shapely)
-        # i) Does the WKT parse correctly to a WKB string, assuming WGS84 for now
+        epsg = int(current.configuration.get("geo.local_epsg"))
+
         try:
-            query_geom = db.executesql(
-                "select st_geomfromtext('{}', 4326);".format(wkt)
-            )[0][0]
-        except (db._adapter.driver.ProgrammingError, db._adapter.driver.InternalError):
-            return {"error": 400, "message": "Could not parse WKT geometry"}
-
-        # ii) Do the coordinates seem like lat long?
-        is_lat_long = db.executesql(
-            "SELECT ST_XMin(g) >= -180 AND ST_XMax(g) <= 180 AND "
-            "   ST_YMin(g) >= -90 AND ST_YMax(g) <= 90 "
-            "   FROM (SELECT st_geomfromwkb(decode('{0}', 'hex')) "
-            "AS g) AS sel ;".format(query_geom)
-        )[0][0]
-        if not is_lat_long:
-            return {"error": 400, "message": "WKT geometry coordinates not as lat/long"}
-
-        # iii) Convert to local projected
-        query_geom = db.executesql(
-            "SELECT st_transform(st_geomfromwkb(decode('{0}', 'hex')), {1});".format(
-                query_geom, current.configuration.get("geo.local_epsg")
-            )
-        )[0][0]
+            query_geom = _parse_wkt(wkt, epsg)
+        except ValueError as err:
+            return {"error": 400, "message": str(err)}
 
     return query_geom
 
 
-def dataset_spatial_search(wkt=None, location=None, distance=0):
+def dataset_spatial_search(
+    wkt: str = None, location: typing.List[str] = None, distance: float = 0
+):
 
     """Spatial search for sampling locations.
 
@@ -582,13 +2756,17 @@ def dataset_spatial_search(wkt=None, location=None, distance=0):
     each dataset are tested to see if they intersect the search geometry and a buffer
     distance can also be provided to search around the query geometry.
 
-    Note that this endpoint will not retrieve datasets that have not provided sampling
-    locations or use new locations that are missing coordinate information. The bounding
+    Sampling locations are matched using the geometry of the gazetteer location that
+    the location name or alias resolves to, or the coordinates provided for new
+    locations in the dataset. Note that this
+    endpoint will not retrieve datasets that have not provided sampling locations or
+    use new locations that are missing coordinate information. The bounding
     box endpoint uses the dataset geographic extent, which is provided for all datasets.
 
     Examples:
         /api/search/spatial.json?location=A_1
         /api/search/spatial.json?location=A_1&distance=50
+        /api/search/spatial.json?location=A_1&location=B_1
         /api/search/spatial.json?wkt=Point(116.5 4.75)
         /api/search/spatial.json?wkt=Point(116.5 4.75)&distance=50000
         /api/search/spatial.json?wkt=Polygon((110 0, 110 10,120 10,120 0,110 0))
@@ -596,8 +2774,8 @@ def dataset_spatial_search(wkt=None, location=None, distance=0):
     Args:
         wkt (str): A well-known text geometry. This is assumed to use latitude and
             longitude coordinates in WGS84 (EPSG:4326).
-        location (str): A location name used to select a query geometry from the SAFE
-            gazetteer.
+        location (str): One or more location names used to select a query geometry
+            from the SAFE gazetteer.
         distance (float): A search distance in metres. All geometries are converted to
             the local projection to provide appopriate distance searching.
     """
@@ -609,20 +2787,33 @@ def dataset_spatial_search(wkt=None, location=None, distance=0):
     if isinstance(query_geom, dict):
         return query_geom
 
-    qry = (
-        (db.published_datasets.id == db.dataset_locations.dataset_id)
-        & (db.dataset_locations.name == db.gazetteer.location)
-        & (
-            (db.gazetteer.wkt_local.st_distance(query_geom) <= distance)
-            | (db.dataset_locations.wkt_local.st_distance(query_geom) <= distance)
+    # Use the in-memory spatial engine to find matching datasets, if it is enabled
+    engine = get_spatial_engine()
+    if engine is not None:
+        ids = engine.location_search(
+            shapely_wkb.loads(query_geom, hex=True), distance, get_gazetteer()
         )
-    )
+        return _match_any(db.published_datasets.id, sorted(ids))
+
+    # Dataset locations match using the geometry of the gazetteer location they resolve
+    # to or, for new locations that are not in the gazetteer, using the geometry
+    # provided in the dataset. The resolved locations table holds the right geometry,
+    # so this is a single ST_DWithin subquery that can use the GiST index.
+    location_ids = db(
+        db.dataset_location_resolved.wkt_local.st_dwithin(query_geom, distance)
+    )._select(db.dataset_location_resolved.dataset_id)
+
+    qry = db.published_datasets.id.belongs(location_ids)
 
     return qry
 
 
 def dataset_spatial_bbox_search(
-    wkt=None, location=None, match_type="intersect", distance=None
+    wkt: str = None,
+    location: typing.List[str] = None,
+    match_type: str = "intersect",
+    distance: float = None,
+    geometry: str = "extent",
 ):
 
     """Spatial search for dataset bounding boxes
@@ -632,21 +2823,32 @@ def dataset_spatial_bbox_search(
     box, which is provided for all datasets, rather than sampling location information
     which may not be recorded for some datasets.
 
+    The search can instead use dataset footprints, which are the convex hulls of the
+    dataset sampling locations, or the bounding box for datasets without sampling
+    locations. Footprints are much closer to the sampling locations than the bounding
+    box for datasets with widely spread locations, such as long transects, so give
+    fewer false matches.
+
     Examples:
         /api/search/bbox.json?wkt=Polygon((110 0, 110 10,120 10,120 0,110 0))
         /api/search/bbox.json?wkt=Polygon((116 4.5,116 5,117 5,117 4.5,116 4.5))
         /api/search/bbox.json?wkt=Polygon((116 4.5,116 5,117 5,117 4.5,116 4.5))&match_type=contain
         /api/search/bbox.json?wkt=Point(116.5 4.75)&match_type=within
+        /api/search/bbox.json?wkt=Point(116.5 4.75)&geometry=footprint
 
     Args:
         wkt (str): A well-known text geometry. This is assumed to use latitude and longitude
             coordinates in WGS84 (EPSG:4326).
-        location (str): A location name used to select a query geometry from the SAFE
-            gazetteer.
+        location (str): One or more location names used to select a query geometry
+            from the SAFE gazetteer.
         match_type (str): One of 'intersect', 'contain' and 'within' to match the
             provided geometry to the geographic extents of datasets. The 'contain'
             option returns datasets that completely cover the query geometry and
             'within' returns datasets that fall entirely within the query geometry.
+        distance (float): A search distance in metres, used with the 'distance' match
+            type.
+        geometry (str): One of 'extent' or 'footprint' to match the query geometry
+            to the bounding boxes or footprints of datasets.
     """
 
     db = current.db
@@ -663,17 +2865,481 @@ def dataset_spatial_bbox_search(
             "message": "Unknown spatial match type: {}".format(match_type),
         }
 
+    if geometry == "extent":
+        geom_field = db.published_datasets.geographic_extent_local
+    elif geometry == "footprint":
+        geom_field = db.published_datasets.geographic_footprint_local
+    else:
+        return {"error": 400, "message": f"Unknown bbox geometry: {geometry}"}
+
+    # Use the in-memory spatial engine to find matching datasets, if it is enabled
+    engine = get_spatial_engine()
+    if engine is not None:
+        ids = engine.extent_search(
+            shapely_wkb.loads(query_geom, hex=True), match_type, distance, geometry
+        )
+        return _match_any(db.published_datasets.id, sorted(ids))
+
     # Query the geographic extents with the appropriate predicate
     if match_type == "intersect":
-        qry = db.published_datasets.geographic_extent_local.st_intersects(query_geom)
+        qry = geom_field.st_intersects(query_geom)
     elif match_type == "contain":
-        qry = db.published_datasets.geographic_extent_local.st_contains(query_geom)
+        qry = geom_field.st_contains(query_geom)
     elif match_type == "within":
-        qry = db.published_datasets.geographic_extent_local.st_within(query_geom)
+        qry = geom_field.st_within(query_geom)
     elif match_type == "distance":
-        qry = (
-            db.published_datasets.geographic_extent_local.st_distance(query_geom)
-            <= distance
+        qry = geom_field.st_dwithin(query_geom, distance or 0)
+
+    return qry
+
+
+def dataset_nearest_search(
+    wkt: str = None,
+    location: typing.List[str] = None,
+    k: int = 10,
+    geometry: str = "locations",
+    most_recent: bool = False,
+    ids: typing.List[int] = None,
+):
+
+    """Search for the datasets nearest to a location
+
+    This endpoint finds the k datasets closest to either a user-provided geometry or
+    the geometry of a named location from the gazetteer, without needing a search
+    distance. By default, datasets are found using their sampling locations, matched
+    in the same way as the spatial search, but the dataset bounding boxes can be used
+    instead to include datasets without sampling locations. The results are ordered
+    by increasing distance and give the distance in metres to the nearest sampling
+    location or bounding box of each dataset. The shared most_recent and ids options
+    are applied when finding the nearest datasets, so k datasets are returned when
+    there are k matching datasets.
+
+    Examples:
+        /api/search/nearest.json?wkt=Point(116.5 4.75)
+        /api/search/nearest.json?wkt=Point(116.5 4.75)&k=5
+        /api/search/nearest.json?location=A_1&geometry=extent
+
+    Args:
+        wkt (str): A well-known text geometry. This is assumed to use latitude and
+            longitude coordinates in WGS84 (EPSG:4326).
+        location (str): One or more location names used to select a query geometry
+            from the SAFE gazetteer.
+        k (int): The number of datasets to return, up to 1000.
+        geometry (str): One of 'locations', 'extent' or 'footprint' to find the
+            nearest datasets using the sampling locations, bounding boxes or
+            footprints of datasets.
+    """
+
+    db = current.db
+
+    # validate the query geometry options and report back if there is an error
+    query_geom = dataset_parse_spatial(wkt, location)
+    if isinstance(query_geom, dict):
+        return query_geom
+
+    if not 0 < k <= NEAREST_MAX_K:
+        return {
+            "error": 400,
+            "message": f"The number of datasets must be between 1 and {NEAREST_MAX_K}",
+        }
+
+    if geometry == "locations":
+        geom_field = db.dataset_location_resolved.wkt_local
+        dataset_id = db.dataset_location_resolved.dataset_id
+    elif geometry in ("extent", "footprint"):
+        geom_field = db.published_datasets[f"geographic_{geometry}_local"]
+        dataset_id = db.published_datasets.id
+    else:
+        return {"error": 400, "message": f"Unknown nearest geometry: {geometry}"}
+
+    expand = db._adapter.expand
+
+    # The PostGIS <-> operator gives the distance between geometries and ordering by it
+    # uses the GiST index to read geometries in order of distance.
+    def _knn_distance(first, second, query_env={}):
+        return "(%s <-> %s)" % (
+            expand(first, query_env=query_env),
+            expand(second, first.type, query_env=query_env),
+        )
+
+    distance = Expression(db, _knn_distance, geom_field, query_geom, "double")
+
+    # Only read the geometries of datasets that can be returned
+    eligible = geom_field != None
+
+    if geometry == "locations":
+        eligible &= db.published_datasets.id == dataset_id
+
+    if most_recent:
+        eligible &= db.published_datasets.most_recent == True
+
+    if ids is not None:
+        eligible &= _match_any(db.published_datasets.zenodo_record_id, ids)
+
+    # Datasets can have many sampling locations, so read increasing numbers of the
+    # nearest geometries until k datasets are found or all geometries have been read.
+    n_rows = k
+    while True:
+        rows = PREPARED_STATEMENTS.executesql(
+            db(eligible)._select(
+                dataset_id, distance, orderby=distance, limitby=(0, n_rows)
+            )
+        )
+        nearest = list(OrderedDict.fromkeys(row[0] for row in rows))
+
+        if len(nearest) >= k or len(rows) < n_rows:
+            break
+
+        n_rows *= 4
+
+    qry = _match_any(dataset_id, nearest[:k])
+    if geometry == "locations":
+        qry &= db.published_datasets.id == dataset_id
+
+    return RankedQuery(qry, distance, "distance", True)
+
+
+def dataset_batch_spatial_search(
+    search_type,
+    features=None,
+    location=None,
+    distance=0,
+    match_type="intersect",
+    geometry="extent",
+    most_recent=False,
+    ids=None,
+):
+    """
+    Function to run a spatial or bbox search for each of a batch of query geometries in
+    a single query. The geometries are provided as a GeoJSON FeatureCollection or as a
+    list of location names from the gazetteer, and are joined to the dataset locations
+    or to the geographic extents or footprints as a VALUES list. This returns a count
+    of the query geometries and an entry for each geometry, in the order provided,
+    giving the index and the feature id or location name of the geometry and the
+    matching datasets, or an error dictionary.
+    """
+
+    db = current.db
+    epsg = int(current.configuration.get("geo.local_epsg"))
+
+    # Get a list of names and local hex EWKB geometries for the query geometries
+    if (features is None) == (location is None):
+        return {
+            "error": 400,
+            "message": "Provide either GeoJSON features or location names",
+        }
+    elif location is not None:
+        gazetteer = get_gazetteer()
+        if gazetteer is None:
+            return {"error": 400, "message": "Gazetteer data not loaded"}
+
+        try:
+            queries = [(nm, gazetteer.query_geometry([nm])) for nm in location]
+        except ValueError as err:
+            return {"error": 400, "message": str(err)}
+    else:
+        is_collection = (
+            isinstance(features, dict) and features.get("type") == "FeatureCollection"
+        )
+        if not is_collection:
+            return {"error": 400, "message": "Features must be a FeatureCollection"}
+
+        queries = []
+        for idx, ft in enumerate(features.get("features") or []):
+            try:
+                geom = shape(ft["geometry"])
+                if geom.is_empty:
+                    raise ValueError("Empty geometry")
+            except (AttributeError, KeyError, TypeError, ValueError, ShapelyError):
+                return {"error": 400, "message": f"Could not parse feature {idx}"}
+
+            try:
+                queries.append(
+                    (ft.get("id"), _project_geometry(geom, epsg, f"Feature {idx}"))
+                )
+            except ValueError as err:
+                return {"error": 400, "message": str(err)}
+
+    if not 0 < len(queries) <= BATCH_SEARCH_MAX_FEATURES:
+        return {
+            "error": 400,
+            "message": f"Provide between 1 and {BATCH_SEARCH_MAX_FEATURES} geometries",
+        }
+
+    # Get the join from the query geometries to the published datasets
+    if search_type == "spatial":
+        join = (
+            "JOIN dataset_location_resolved ON "
+            "ST_DWithin(dataset_location_resolved.wkt_local, query.geom, %s) "
+            "JOIN published_datasets "
+            "ON published_datasets.id = dataset_location_resolved.dataset_id"
+        )
+        placeholders = [distance or 0]
+    elif search_type == "bbox":
+        predicates = {
+            "intersect": "ST_Intersects({}, query.geom)",
+            "contain": "ST_Contains({}, query.geom)",
+            "within": "ST_Within({}, query.geom)",
+            "distance": "ST_DWithin({}, query.geom, %s)",
+        }
+
+        if match_type not in predicates:
+            return {
+                "error": 400,
+                "message": "Unknown spatial match type: {}".format(match_type),
+            }
+
+        if geometry not in ("extent", "footprint"):
+            return {"error": 400, "message": f"Unknown bbox geometry: {geometry}"}
+
+        geom_field = f"published_datasets.geographic_{geometry}_local"
+        predicate = predicates[match_type].format(geom_field)
+        join = f"JOIN published_datasets ON {predicate}"
+        placeholders = [distance or 0] if match_type == "distance" else []
+    else:
+        return {"error": 400, "message": f"Unknown batch search type: {search_type}"}
+
+    where = ["TRUE"]
+    if most_recent:
+        where.append("published_datasets.most_recent = 'T'")
+
+    if ids is not None:
+        where.append("published_datasets.zenodo_record_id = ANY(%s)")
+        placeholders.append(list(ids))
+
+    # The VALUES list numbers the query geometries and comes first in the statement
+    values = ", ".join(["(%s, CAST(%s AS geometry))"] * len(queries))
+    placeholders = [
+        vl for idx, (_, geom) in enumerate(queries) for vl in (idx, geom)
+    ] + placeholders
+
+    rows = db.executesql(
+        "SELECT DISTINCT query.feature, published_datasets.zenodo_concept_id, "
+        "published_datasets.zenodo_record_id, published_datasets.dataset_title "
+        f"FROM (VALUES {values}) AS query (feature, geom) {join} "
+        f"WHERE {' AND '.join(where)} "
+        "ORDER BY query.feature, published_datasets.zenodo_record_id;",
+        placeholders=placeholders,
+    )
+
+    entries = [
+        {"feature": idx, "id": nm, "count": 0, "datasets": []}
+        for idx, (nm, _) in enumerate(queries)
+    ]
+    for idx, concept_id, record_id, title in rows:
+        entries[idx]["count"] += 1
+        entries[idx]["datasets"].append(
+            {
+                "zenodo_concept_id": concept_id,
+                "zenodo_record_id": record_id,
+                "dataset_title": title,
+            }
+        )
+
+    return dict(count=len(entries), entries=entries)
+
+
+def dataset_compound_search(match_type: str = "all", **criteria):
+
+    """Search for datasets using several search criteria in a single request
+
+    Each criterion is given as a search type and one of the query variables for that
+    search type, separated by a full stop: for example, taxa.name or spatial.distance.
+    The criteria for each search type are applied exactly as in the search endpoint for
+    that type and then the search types are combined, returning datasets that match
+    all of the search types or any of them. The whole search is run as a single
+    database query. Name similarity scores are not used to rank compound searches.
+
+    Examples:
+        /api/search/compound.json?taxa.name=Formicidae&dates.date=2014-01-01,2014-12-31
+        /api/search/compound.json?taxa.name=Formicidae&spatial.location=A_1&spatial.distance=5000
+        /api/search/compound.json?authors.name=Wilk&text.text=humus&match_type=any
+
+    Args:
+        match_type (str): One of 'all' or 'any', to return datasets that match all of
+            the search types or any of them.
+        criteria: Query variables for the other search types, in the form
+            search_type.variable.
+    """
+
+    db = current.db
+
+    if match_type not in ["all", "any"]:
+        return {
+            "error": 400,
+            "message": "Unknown compound match type: {}".format(match_type),
+        }
+
+    # Group the criteria by search type, checking the search types and arguments
+    searches = {}
+    for key, value in criteria.items():
+        search_type, _, arg = key.partition(".")
+        search = SEARCH_REGISTRY.get(search_type)
+
+        if search is None or search.keywords:
+            return {"error": 400, "message": "Unknown search type: {}".format(key)}
+
+        if arg not in search.params:
+            return {"error": 400, "message": "Unknown search variable: {}".format(key)}
+
+        searches.setdefault(search_type, {})[arg] = value
+
+    if not searches:
+        return {"error": 400, "message": "Provide at least one search criterion"}
+
+    # Each search type is added as a subquery on dataset ids, so that the joins from
+    # different search types do not multiply rows or interfere with each other.
+    qry = None
+    for search_type, args in searches.items():
+        try:
+            search_qry = SEARCH_REGISTRY[search_type](**args)
+        except ValueError as err:
+            return {"error": 400, "message": str(err)}
+
+        if isinstance(search_qry, dict):
+            return search_qry
+        elif isinstance(search_qry, RankedQuery):
+            search_qry = search_qry.query
+
+        search_qry = db.published_datasets.id.belongs(
+            db(search_qry)._select(db.published_datasets.id)
         )
 
+        if qry is None:
+            qry = search_qry
+        elif match_type == "all":
+            qry &= search_qry
+        else:
+            qry |= search_qry
+
     return qry
+
+
+# A dictionary of search endpoint names and the underlying functions.
+SEARCH_FUNC = {
+    "taxa": dataset_taxon_search,
+    "authors": dataset_author_search,
+    "dates": dataset_date_search,
+    "text": dataset_text_search,
+    "fields": dataset_field_search,
+    "locations": dataset_locations_search,
+    "spatial": dataset_spatial_search,
+    "bbox": dataset_spatial_bbox_search,
+    "nearest": dataset_nearest_search,
+    "compound": dataset_compound_search,
+}
+
+
+def _parse_flag(value):
+    """
+    Convert a request value for a flag to a boolean, where an empty value, as given by
+    a variable with no value in a query string, sets the flag.
+    """
+
+    if isinstance(value, bool):
+        return value
+
+    value = str(value).lower()
+    if value in ("", "true", "1", "yes"):
+        return True
+    elif value in ("false", "0", "no"):
+        return False
+
+    raise ValueError(f"Unknown flag value: {value}")
+
+
+class SearchType:
+    """A search type in the search registry.
+
+    The registry is built when this module is loaded, using the signature of each
+    search function to record the names and types of its query variables. The type
+    annotations on the search functions give the variable types, which default to
+    strings, and request values are checked and converted to those types once, before
+    the search is run. Variables with list types accept one or more values and are
+    always passed to the search function as a list. Boolean variables are flags, which
+    are set by providing the variable with no value. Search functions taking keyword
+    arguments, such as the compound search, check those arguments themselves.
+
+    Search functions can also take the shared most_recent and ids variables, which are
+    then passed to the function as well as being applied to the search results, for
+    searches such as the nearest search that need to apply them within the search.
+    """
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.params = OrderedDict()
+        self.shared = set()
+        self.keywords = False
+
+        for param in inspect.signature(func).parameters.values():
+            if param.kind == param.VAR_KEYWORD:
+                self.keywords = True
+            elif param.name in ("most_recent", "ids"):
+                self.shared.add(param.name)
+            elif param.annotation is param.empty:
+                self.params[param.name] = str
+            else:
+                self.params[param.name] = param.annotation
+
+    def coerce(self, args):
+        """
+        Check a dictionary of request variables against the search parameters and
+        convert the values to the parameter types, raising a ValueError if a variable
+        is unknown or a value cannot be converted.
+        """
+
+        unknown_args = set(args) - set(self.params)
+
+        if unknown_args and not self.keywords:
+            unknown_args = ",".join(sorted(unknown_args))
+            raise ValueError(
+                f"Unknown variables for search/{self.name}: {unknown_args}"
+            )
+
+        values = {}
+        for key, value in args.items():
+            param_type = self.params.get(key)
+
+            # Keyword arguments are passed on unchanged
+            if param_type is None:
+                values[key] = value
+                continue
+
+            # List parameters accept one or more values, other parameters one value
+            if typing.get_origin(param_type) is list:
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                elif not value:
+                    raise ValueError(f"Provide at least one value for {key}")
+
+                param_type = typing.get_args(param_type)[0]
+            elif isinstance(value, (list, tuple)):
+                raise ValueError(f"Provide a single value for {key}")
+
+            # Flags are set by providing the variable without a value
+            if param_type is bool:
+                param_type = _parse_flag
+
+            try:
+                if isinstance(value, (list, tuple)):
+                    values[key] = [param_type(vl) for vl in value]
+                else:
+                    values[key] = param_type(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Could not parse {key}: {value}")
+
+        return values
+
+    def shared_args(self, most_recent=False, ids=None):
+        """Get the shared variables that are used by the search function."""
+
+        shared = dict(most_recent=most_recent, ids=ids)
+        return {ky: vl for ky, vl in shared.items() if ky in self.shared}
+
+    def __call__(self, **args):
+        return self.func(**self.coerce(args))
+
+
+# The search registry of search endpoint names and typed search functions
+SEARCH_REGISTRY = {ky: SearchType(ky, fn) for ky, fn in SEARCH_FUNC.items()}
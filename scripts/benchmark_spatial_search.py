@@ -0,0 +1,96 @@
+"""
+SPATIAL SEARCH BENCHMARK
+- Compares the spatial location search against the original query, which joined the
+  dataset locations to the gazetteer and filtered on ST_Distance, using a sample of
+  gazetteer locations as query geometries at a range of distances.
+- Reports the best time for each query, checks that the search finds all the datasets
+  found by the original query and checks the query plan uses the GiST indexes.
+- Run this within the application environment:
+
+    python web2py.py -S safedata_server -M \
+        -R applications/safedata_server/scripts/benchmark_spatial_search.py
+"""
+
+import sys
+import timeit
+
+from safedata_server_api import dataset_parse_spatial, dataset_spatial_search
+
+N_LOCATIONS = 20
+DISTANCES = [0, 100, 1000, 10000]
+REPEATS = 5
+
+
+def original_query(query_geom, distance):
+    return (
+        (db.published_datasets.id == db.dataset_locations.dataset_id)
+        & (db.dataset_locations.name == db.gazetteer.location)
+        & (
+            (db.gazetteer.wkt_local.st_distance(query_geom) <= distance)
+            | (db.dataset_locations.wkt_local.st_distance(query_geom) <= distance)
+        )
+    )
+
+
+def dataset_ids(qry):
+    sql = db(qry)._select(db.published_datasets.id, distinct=True)
+    return {row[0] for row in db.executesql(sql)}
+
+
+def best_time(qry):
+    sql = db(qry)._select(db.published_datasets.id, distinct=True)
+    return min(timeit.repeat(lambda: db.executesql(sql), number=1, repeat=REPEATS))
+
+
+def uses_gist(qry):
+    sql = db(qry)._select(db.published_datasets.id, distinct=True)
+    plan = "\n".join(row[0] for row in db.executesql("EXPLAIN " + sql))
+    return "Index Scan" in plan and "_gist" in plan
+
+
+def main():
+    if configuration.get("geo.spatial_engine") == "memory":
+        sys.exit("The in-memory spatial engine is enabled: no SQL to benchmark")
+
+    locations = db(db.gazetteer).select(
+        db.gazetteer.location, orderby=db.gazetteer.id, limitby=(0, N_LOCATIONS)
+    )
+
+    print(
+        f"{'location':<40}{'distance':>10}{'original':>12}{'search':>12}"
+        f"{'n_orig':>8}{'n_new':>8}  gist"
+    )
+
+    failures = 0
+
+    for loc in locations:
+        query_geom = dataset_parse_spatial(None, [loc.location])
+
+        for distance in DISTANCES:
+            old_qry = original_query(query_geom, distance)
+            new_qry = dataset_spatial_search(location=[loc.location], distance=distance)
+
+            old_ids = dataset_ids(old_qry)
+            new_ids = dataset_ids(new_qry)
+            gist = uses_gist(new_qry)
+
+            # The search also finds datasets through location aliases and the
+            # geometries of new locations that are not in the gazetteer, so can find
+            # more datasets, but never fewer.
+            if not old_ids <= new_ids or not gist:
+                failures += 1
+
+            old_time = best_time(old_qry) * 1000
+            new_time = best_time(new_qry) * 1000
+
+            print(
+                f"{loc.location[:38]:<40}{distance:>10}"
+                f"{old_time:>10.2f}ms{new_time:>10.2f}ms"
+                f"{len(old_ids):>8}{len(new_ids):>8}  {'yes' if gist else 'no'}"
+            )
+
+    if failures:
+        sys.exit(f"{failures} queries lost datasets or did not use the GiST indexes")
+
+
+main()
@@ -0,0 +1,25 @@
+"""
+DATASET TAXA MIGRATION
+- Converts the taxa recorded in the original dataset_taxa table, which repeated the
+  taxon details for each dataset, to the taxa and dataset_taxon_links tables.
+- Datasets that already have taxon links are skipped, so this can be run again
+  safely, and the original dataset_taxa table is left in place. It can be dropped
+  once the converted data has been checked.
+- Run this once, from a single process, within the application environment:
+
+    python web2py.py -S safedata_server -M \
+        -R applications/safedata_server/scripts/migrate_dataset_taxa.py
+"""
+
+from safedata_server_api import migrate_dataset_taxa
+
+
+def main():
+    n_converted = migrate_dataset_taxa()
+    db.commit()
+
+    print(f"Converted {n_converted} dataset_taxa rows")
+    print(f"{db(db.taxa).count()} taxa linked to datasets")
+
+
+main()